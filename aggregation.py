@@ -0,0 +1,84 @@
+from collections import defaultdict
+
+# --- 月別集計 ---
+class MonthlyAggregator:
+    """(ユーザー名, 年月, 起床/就寝) ごとの合計秒数と件数を保持する
+
+    1日分の記録が追加・置き換えられるたびに差分だけを反映するため、
+    集計のコストは履歴全体ではなく変更のあった日数に比例する。
+    年月は論理日付 (朝4時区切り) の "YYYY-MM"、年月を None にしたバケットは全期間の累計。
+    """
+    KINDS = ('wake', 'sleep')
+
+    def __init__(self):
+        self.buckets = defaultdict(lambda: [0, 0])  # (ユーザー名, 年月, 種別) -> [合計秒数, 件数]
+        self.user_names = {}  # 挿入順を保つため dict をセットとして使う
+        self.year_months = set()
+
+    @classmethod
+    def from_records(cls, records):
+        """DailyRecords の列をまとめて集計して初期状態を作る"""
+        aggregator = cls()
+        for user_name in records.users():
+            aggregator.user_names[user_name] = None
+        for kind in cls.KINDS:
+            for (user_name, ym), (total, count) in records.groupby_month(kind).items():
+                for bucket_ym in (ym, None):
+                    bucket = aggregator.buckets[(user_name, bucket_ym, kind)]
+                    bucket[0] += total
+                    bucket[1] += count
+                aggregator.year_months.add(ym)
+        return aggregator
+
+    def replace(self, user_name, date_str, kind, old_sec, new_sec):
+        """1日分の記録を old_sec から new_sec (time_to_seconds の秒数) に置き換える (新規の場合は old_sec=None)"""
+        ym = date_str[:7]
+        delta_sec = new_sec
+        delta_count = 1
+        if old_sec is not None:
+            delta_sec -= old_sec
+            delta_count = 0
+
+        for bucket_ym in (ym, None):
+            bucket = self.buckets[(user_name, bucket_ym, kind)]
+            bucket[0] += delta_sec
+            bucket[1] += delta_count
+        self.user_names[user_name] = None
+        self.year_months.add(ym)
+
+    def users(self):
+        return list(self.user_names)
+
+    def count(self, user_name, kind, ym=None):
+        bucket = self.buckets.get((user_name, ym, kind))
+        return bucket[1] if bucket else 0
+
+    def mean(self, user_name, kind, ym=None):
+        """平均秒数 (記録が無ければ None)"""
+        bucket = self.buckets.get((user_name, ym, kind))
+        if not bucket or not bucket[1]: return None
+        return bucket[0] / bucket[1]
+
+    def has_records(self, user_name, ym):
+        return any(self.count(user_name, kind, ym) for kind in self.KINDS)
+
+def build_ranking(aggregator, current_ym, prev_ym):
+    """ランキング用の集計結果を、今月の平均起床時刻が早い順に返す"""
+    analysis_data = []
+    for user_name in aggregator.users():
+        cur_w_avg = aggregator.mean(user_name, 'wake', current_ym)
+        prev_w_avg = aggregator.mean(user_name, 'wake', prev_ym)
+        
+        analysis_data.append({
+            'userName': user_name, 
+            'overall_wake_avg': aggregator.mean(user_name, 'wake'), 
+            'overall_count': aggregator.count(user_name, 'wake'),
+            'current_wake_avg': cur_w_avg, 
+            'previous_wake_avg': prev_w_avg, 
+            'current_sleep_avg': aggregator.mean(user_name, 'sleep', current_ym),
+            'previous_sleep_avg': aggregator.mean(user_name, 'sleep', prev_ym),
+            'delta_sec': cur_w_avg - prev_w_avg if (cur_w_avg is not None and prev_w_avg is not None) else None
+        })
+
+    analysis_data.sort(key=lambda x: x['current_wake_avg'] if x['current_wake_avg'] is not None else float('inf'))
+    return analysis_data
@@ -0,0 +1,400 @@
+"""オフラインのベンチマーク
+
+Discord もスプレッドシートも使わず、合成したメッセージ履歴と偽のチャンネル・ワークシートで
+取り込み・保存/読み込み・シートの描画を計測する。
+
+    python bench.py --sizes 10x30,50x180,100x365 --output bench_results.json
+
+サイズは「ユーザー数x日数」。各ケースの経過時間・ピークメモリ・Sheets API 呼び出し回数と送受信バイト数を表示し、JSON に保存する。
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, namedtuple
+
+from aggregation import MonthlyAggregator, build_ranking
+from codec import RowCodec
+from ingest import fold_observation, run_pipeline
+from records import DailyRecords
+from publish import SheetViewPublisher, update_spreadsheet, render_monthly_average_rows, update_monthly_average_sheet
+from storage import SheetsHistoryStore, SqliteHistoryStore, new_watermark
+from timeutil import JST
+
+# --- 合成データ ---
+FakeAuthor = namedtuple('FakeAuthor', ['id', 'global_name', 'name', 'bot'])
+FakeMessage = namedtuple('FakeMessage', ['id', 'author', 'content', 'created_at'])
+
+END_DATE = datetime.date(2026, 6, 30)  # 就寝列のある月 (2026/05 以降) を含める
+DISCORD_EPOCH_MS = 1420070400000
+
+MANUAL_TEXTS = ["{h}:{m:02d}起床", "{h}時{m}分に起きた", "{h}時半", "おはよう {h}：{m:02d}"]
+PLAIN_TEXTS = ["おはよう", "起きた", "おはようございます", "おやすみ", "寝ます"]
+
+def snowflake(dt, seq):
+    """作成日時から Discord 形式のメッセージIDを作る (日時順に単調増加する)"""
+    return ((int(dt.timestamp() * 1000) - DISCORD_EPOCH_MS) << 22) | (seq & 0x3FFFFF)
+
+def generate_messages(users, days, seed=0):
+    """users 人 × days 日分の起床/就寝の投稿を作る (投稿日時の昇順)
+
+    起床は 7:00 前後、就寝は 23:30 前後に正規分布でばらつかせ、一部は投稿を休む・
+    二度投稿する・本文で時刻を指定する・bot が投稿する、といった揺らぎを入れる。
+    """
+    rng = random.Random(seed)
+    authors = [FakeAuthor(1000 + i, f"user{i:03d}" if rng.random() < 0.8 else None, f"name{i:03d}", False) for i in range(users)]
+    bot_author = FakeAuthor(1, None, 'bot', True)
+    first_day = END_DATE - datetime.timedelta(days=days - 1)
+
+    posts = []
+    for offset in range(days):
+        midnight = datetime.datetime.combine(first_day + datetime.timedelta(days=offset), datetime.time(), JST)
+        for author in authors:
+            if rng.random() < 0.85:
+                wake_min = min(max(rng.gauss(7 * 60, 60), 4 * 60 + 5), 17 * 60)
+                posted = midnight + datetime.timedelta(minutes=wake_min)
+                content = rng.choice(PLAIN_TEXTS[:3])
+                if rng.random() < 0.15:
+                    # 起きた時刻を後から本文で申告する
+                    stated = posted - datetime.timedelta(minutes=rng.randint(5, 90))
+                    if stated.hour >= 4:
+                        content = rng.choice(MANUAL_TEXTS).format(h=stated.hour, m=stated.minute)
+                posts.append((posted, author, content))
+                if rng.random() < 0.1:
+                    posts.append((posted + datetime.timedelta(minutes=rng.randint(1, 120)), author, "二度目の投稿"))
+            if rng.random() < 0.7:
+                sleep_min = min(max(rng.gauss(23.5 * 60, 60), 18 * 60 + 5), 27 * 60 + 50)
+                posts.append((midnight + datetime.timedelta(minutes=sleep_min), author, rng.choice(PLAIN_TEXTS[3:])))
+        if rng.random() < 0.3:
+            posts.append((midnight + datetime.timedelta(hours=12), bot_author, "集計が完了しました"))
+
+    posts.sort(key=lambda post: post[0])
+    return [
+        FakeMessage(snowflake(posted, seq), author, content, posted.astimezone(datetime.timezone.utc))
+        for seq, (posted, author, content) in enumerate(posts)
+    ]
+
+class FakeChannel:
+    """TextChannel.history() の代わり。page_size 件ずつ (必要なら latency 秒待って) 返す"""
+    def __init__(self, messages, page_size=100, latency=0.0):
+        self.messages = messages
+        self.page_size = page_size
+        self.latency = latency
+        self.pages = 0
+
+    async def history(self, limit=None, after=None, oldest_first=True):
+        messages = self.messages
+        if after is not None:
+            messages = [m for m in messages if m.id > after.id]
+        if not oldest_first:
+            messages = messages[::-1]
+        if limit is not None:
+            messages = messages[:limit]
+        for start in range(0, len(messages), self.page_size):
+            self.pages += 1
+            if self.latency: await asyncio.sleep(self.latency)
+            for message in messages[start:start + self.page_size]:
+                yield message
+
+# --- メモリ上のスプレッドシート ---
+class ApiCounter:
+    """Sheets API の呼び出し回数と送受信バイト数 (JSON 換算) を数える"""
+    def __init__(self):
+        self.calls = Counter()
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
+    def record(self, method, payload=None, response=None):
+        self.calls[method] += 1
+        if payload is not None: self.sent_bytes += len(json.dumps(payload, ensure_ascii=False).encode())
+        if response is not None: self.received_bytes += len(json.dumps(response, ensure_ascii=False).encode())
+        return response
+
+    def summary(self):
+        return {'calls': sum(self.calls.values()), 'by_method': dict(self.calls), 'sent_bytes': self.sent_bytes, 'received_bytes': self.received_bytes}
+
+_A1 = re.compile(r"(?:'?([^'!]+)'?!)?([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?")
+
+def parse_a1(a1):
+    """'A2' / 'A2:B' / "'シート'!A3:D3" → (シート名, 開始行, 開始列) (いずれも 0 始まり)"""
+    title, col, row = _A1.fullmatch(a1).group(1, 2, 3)
+    col_index = 0
+    for c in col: col_index = col_index * 26 + ord(c) - 64
+    return title, int(row or 1) - 1, col_index - 1
+
+class FakeWorksheet:
+    """gspread.Worksheet のうち、このリポジトリが使うメソッドだけを持つ"""
+    def __init__(self, spreadsheet, title, sheet_id):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.grid = []
+        self.row_count, self.col_count = 1000, 20  # SheetsSession が作るシートと同じ大きさ
+
+    @property
+    def counter(self):
+        return self.spreadsheet.counter
+
+    def write(self, row, col, values):
+        for r, values_row in enumerate(values):
+            while len(self.grid) <= row + r: self.grid.append([])
+            target = self.grid[row + r]
+            while len(target) < col + len(values_row): target.append('')
+            target[col:col + len(values_row)] = [str(v) for v in values_row]
+
+    def get_all_values(self):
+        width = max((len(row) for row in self.grid), default=0)
+        return self.counter.record('get_all_values', None, [row + [''] * (width - len(row)) for row in self.grid])
+
+    def get(self, a1):
+        _, row, col = parse_a1(a1)
+        end_col = col + 2 if ':' in a1 else col + 1
+        values = [r[col:end_col] for r in self.grid[row:]]
+        return self.counter.record('get', None, values)
+
+    def clear(self):
+        self.grid = []
+        self.counter.record('clear', {})
+
+    def update(self, a1, values):
+        _, row, col = parse_a1(a1)
+        self.write(row, col, values)
+        self.counter.record('update', {'range': a1, 'values': values})
+
+    def append_row(self, values):
+        self.append_rows([values])
+
+    def append_rows(self, values, value_input_option='RAW', table_range=None):
+        first_row = len(self.grid) + 1
+        self.write(first_row - 1, 0, values)
+        updated_range = f"'{self.title}'!A{first_row}:D{first_row + len(values) - 1}"
+        return self.counter.record('append_rows', {'values': values}, {'updates': {'updatedRange': updated_range}})
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.counter = ApiCounter()
+        self.sheets = {}
+
+    def worksheet(self, title):
+        if title not in self.sheets:
+            self.sheets[title] = FakeWorksheet(self, title, len(self.sheets))
+        return self.sheets[title]
+
+    def batch_update(self, body):
+        # 書式のリクエストは数えるだけで、値 (updateCells) とシートの大きさのみ反映する
+        by_id = {sheet.id: sheet for sheet in self.sheets.values()}
+        for req in body['requests']:
+            if 'updateSheetProperties' in req:
+                properties = req['updateSheetProperties']['properties']
+                grid = properties.get('gridProperties', {})
+                sheet = by_id[properties['sheetId']]
+                sheet.row_count = grid.get('rowCount', sheet.row_count)
+                sheet.col_count = grid.get('columnCount', sheet.col_count)
+            if 'updateCells' not in req: continue
+            sheet = by_id[req['updateCells']['range']['sheetId']]
+            values = [[next(iter(cell['userEnteredValue'].values())) for cell in row['values']] for row in req['updateCells']['rows']]
+            # 実際の API と同じく、シートの大きさを超える書き込みは失敗させる
+            if len(values) > sheet.row_count or max(map(len, values), default=0) > sheet.col_count:
+                raise ValueError(f"Range exceeds grid limits: {sheet.title}")
+            sheet.grid = []
+            sheet.write(0, 0, values)
+        self.counter.record('batch_update', body)
+
+    def values_batch_update(self, body):
+        for data in body['data']:
+            title, row, col = parse_a1(data['range'])
+            self.worksheet(title).write(row, col, data['values'])
+        self.counter.record('values_batch_update', body)
+
+# --- 計測対象のケース ---
+# 各ケースは setup(dataset) で状態を用意し、(計測する関数, ApiCounter または None) を返す
+class Dataset:
+    def __init__(self, users, days, seed):
+        self.users, self.days = users, days
+        self.messages = generate_messages(users, days, seed)
+        self.records, self.watermark = ingest(FakeChannel(self.messages))
+        self.aggregator = MonthlyAggregator.from_records(self.records)
+        self.keys = list(self.records.rows())
+        self.current_ym = END_DATE.strftime('%Y-%m')
+        self.prev_ym = (END_DATE.replace(day=1) - datetime.timedelta(days=1)).strftime('%Y-%m')
+
+def ingest(channel):
+    """server の ChannelTracker.sync と同じ流れで履歴を最後まで取り込む"""
+    records, aggregator, watermark = DailyRecords(), MonthlyAggregator(), new_watermark()
+
+    def advance_watermark(message):
+        watermark['last_message_id'] = message.id
+        watermark['last_message_at'] = message.created_at.isoformat()
+
+    def fold(observation):
+        return fold_observation(records, watermark['user_ids'], observation, aggregator)
+
+    asyncio.run(run_pipeline(channel.history(limit=None, oldest_first=True), advance_watermark, fold))
+    return records, watermark
+
+def saved_sheets_store(dataset):
+    spreadsheet = FakeSpreadsheet()
+    store = SheetsHistoryStore(spreadsheet.worksheet('累計データ'), spreadsheet.worksheet('メタデータ'))
+    store.load()
+    store.save(dataset.records, dataset.keys, dataset.watermark)
+    return spreadsheet, store
+
+def case_ingest(dataset):
+    return (lambda: ingest(FakeChannel(dataset.messages))), None
+
+def case_sheets_save_full(dataset):
+    spreadsheet = FakeSpreadsheet()
+    store = SheetsHistoryStore(spreadsheet.worksheet('累計データ'), spreadsheet.worksheet('メタデータ'))
+    store.load()
+    spreadsheet.counter = ApiCounter()
+    return (lambda: store.save(dataset.records, dataset.keys, dataset.watermark)), spreadsheet.counter
+
+def case_sheets_save_delta(dataset):
+    # 最終日の分だけが変更された状態 (定期保存1回分) を、索引を読み直すところから書き込む
+    spreadsheet, _ = saved_sheets_store(dataset)
+    store = SheetsHistoryStore(spreadsheet.worksheet('累計データ'), spreadsheet.worksheet('メタデータ'))
+    last_day = END_DATE.isoformat()
+    keys = [key for key in dataset.keys if key[1] == last_day]
+    spreadsheet.counter = ApiCounter()
+    return (lambda: store.save(dataset.records, keys, dataset.watermark)), spreadsheet.counter
+
+def case_sheets_load(dataset):
+    spreadsheet, _ = saved_sheets_store(dataset)
+    store = SheetsHistoryStore(spreadsheet.worksheet('累計データ'), spreadsheet.worksheet('メタデータ'))
+    spreadsheet.counter = ApiCounter()
+    return store.load, spreadsheet.counter
+
+scratch_dir = None  # main() の間だけ存在する一時ディレクトリ (SQLite のファイル置き場。-wal / -shm も含めて最後に消す)
+db_ids = itertools.count()
+
+def sqlite_path():
+    return os.path.join(scratch_dir, f"bench-{next(db_ids)}.db")
+
+def case_sqlite_save(dataset):
+    store = SqliteHistoryStore(sqlite_path())
+    return (lambda: store.save(dataset.records, dataset.keys, dataset.watermark)), None
+
+def case_sqlite_load(dataset):
+    store = SqliteHistoryStore(sqlite_path())
+    store.save(dataset.records, dataset.keys, dataset.watermark)
+    return store.load, None
+
+def publish_ranking(dataset, sheet, views):
+    update_spreadsheet(sheet, build_ranking(dataset.aggregator, dataset.current_ym, dataset.prev_ym), views)
+
+def publish_monthly(dataset, sheet, views):
+    headers, rows = render_monthly_average_rows(dataset.aggregator)
+    update_monthly_average_sheet(sheet, headers, rows, views)
+
+def case_ranking_render(dataset):
+    spreadsheet = FakeSpreadsheet()
+    sheet = spreadsheet.worksheet('起床時刻ランキング')
+    return (lambda: publish_ranking(dataset, sheet, SheetViewPublisher())), spreadsheet.counter
+
+def case_monthly_render(dataset):
+    spreadsheet = FakeSpreadsheet()
+    sheet = spreadsheet.worksheet('月別平均推移')
+    return (lambda: publish_monthly(dataset, sheet, SheetViewPublisher())), spreadsheet.counter
+
+def case_republish_unchanged(dataset):
+    # 前回と同じ集計結果で両方のシートを再度公開する (書き込みは省かれるはず)
+    spreadsheet, views = FakeSpreadsheet(), SheetViewPublisher()
+    ranking, monthly = spreadsheet.worksheet('起床時刻ランキング'), spreadsheet.worksheet('月別平均推移')
+    publish_ranking(dataset, ranking, views)
+    publish_monthly(dataset, monthly, views)
+    spreadsheet.counter = ApiCounter()
+    def run():
+        publish_ranking(dataset, ranking, views)
+        publish_monthly(dataset, monthly, views)
+    return run, spreadsheet.counter
+
+CASES = [
+    ('ingest', case_ingest),
+    ('sheets_save_full', case_sheets_save_full),
+    ('sheets_save_delta', case_sheets_save_delta),
+    ('sheets_load', case_sheets_load),
+    ('sqlite_save', case_sqlite_save),
+    ('sqlite_load', case_sqlite_load),
+    ('ranking_render', case_ranking_render),
+    ('monthly_render', case_monthly_render),
+    ('republish_unchanged', case_republish_unchanged),
+]
+
+def measure(setup, dataset):
+    """経過時間と API 呼び出しを1回、ピークメモリを tracemalloc 下でもう1回 (別の状態で) 計測する"""
+    run, counter = setup(dataset)
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+
+    run, _ = setup(dataset)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = {'seconds': round(elapsed, 6), 'peak_bytes': peak}
+    if counter is not None: result['sheets'] = counter.summary()
+    return result
+
+def check(dataset):
+    """差分集計と一括集計の一致、行の符号化の往復を確かめる"""
+    full = MonthlyAggregator.from_records(dataset.records)
+    for key, (total, count) in full.buckets.items():
+        if count and tuple(dataset.aggregator.buckets.get(key, (0, 0))) != (total, count):
+            raise AssertionError(f"集計が一致しません: {key}")
+    for compact in (False, True):
+        codec = RowCodec(compact)
+        for user_name, date_str in dataset.keys:
+            decoded = codec.decode_row(codec.encode_row(dataset.records, user_name, date_str))
+            expected = (user_name, date_str, dataset.records.get_seconds(user_name, date_str, 'wake'), dataset.records.get_seconds(user_name, date_str, 'sleep'))
+            if decoded != expected:
+                raise AssertionError(f"符号化の往復が一致しません: {decoded} != {expected}")
+
+def parse_sizes(value):
+    return [tuple(int(n) for n in size.split('x')) for size in value.split(',')]
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('10x30,50x180,100x365'), help='ユーザー数x日数 をカンマ区切りで')
+    arg_parser.add_argument('--cases', default=','.join(name for name, _ in CASES), help='実行するケース名 (カンマ区切り)')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', default='bench_results.json')
+    arg_parser.add_argument('--check', action='store_true', help='集計と符号化の整合性も確かめる')
+    args = arg_parser.parse_args()
+
+    global scratch_dir
+    with tempfile.TemporaryDirectory(prefix='hoyaoki-bench-') as scratch_dir:
+        results = run_cases(args)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'seed': args.seed, 'end_date': END_DATE.isoformat(), 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"✅ {args.output} に保存しました。")
+
+def run_cases(args):
+    selected = args.cases.split(',')
+    results = []
+    for users, days in args.sizes:
+        dataset = Dataset(users, days, args.seed)
+        if args.check: check(dataset)
+        print(f"--- {users} users x {days} days ({len(dataset.messages)} messages, {len(dataset.records)} records) ---")
+        for name, setup in CASES:
+            if name not in selected: continue
+            result = measure(setup, dataset)
+            sheets = result.get('sheets')
+            sheets_text = f"  sheets {sheets['calls']} calls, {sheets['sent_bytes']:,} B sent, {sheets['received_bytes']:,} B received" if sheets else ""
+            print(f"{name:<20} {result['seconds'] * 1000:10.1f} ms  peak {result['peak_bytes'] / 1024:10.1f} KiB{sheets_text}")
+            results.append({'case': name, 'users': users, 'days': days, 'messages': len(dataset.messages), 'records': len(dataset.records), **result})
+    return results
+
+if __name__ == '__main__':
+    main()
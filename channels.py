@@ -0,0 +1,95 @@
+import datetime
+import json
+from zoneinfo import ZoneInfo
+
+from timeutil import JST
+
+# --- 追跡するチャンネルの登録簿 ---
+# チャンネルごとに記録先のスプレッドシート・ローカルDBと、1日の区切り・起床とみなす時間帯・タイムゾーンを持つ。
+# CHANNELS_JSON が無い場合は従来どおり DISCORD_CHANNEL_ID / SHEET_ID の1チャンネルだけを追跡する。
+
+class ChannelConfig:
+    """チャンネル1つ分の設定"""
+    def __init__(self, channel_id, sheet_id, db_path=None, timezone=JST, day_start_hour=4, wake_hours=(4, 18), name=None):
+        self.channel_id = channel_id
+        self.sheet_id = sheet_id
+        self.db_path = db_path
+        self.timezone = timezone
+        self.day_start_hour = day_start_hour  # この時刻より前の投稿は前日の記録として扱う
+        self.wake_hours = tuple(wake_hours)  # [開始, 終了) 時の投稿を起床、それ以外を就寝とみなす
+        self.name = name or str(channel_id)
+
+    @property
+    def sheet_url(self):
+        return f"https://docs.google.com/spreadsheets/d/{self.sheet_id}"
+
+    def now(self):
+        return datetime.datetime.now(self.timezone)
+
+    def localize(self, dt):
+        """投稿時刻をこのチャンネルのタイムゾーンに変換する (タイムゾーン無しは UTC とみなす)"""
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt.astimezone(self.timezone)
+
+    def logical_date(self, local_dt):
+        """day_start_hour 時を1日の境目とした日付 'YYYY-MM-DD'"""
+        return (local_dt - datetime.timedelta(hours=self.day_start_hour)).strftime("%Y-%m-%d")
+
+    def is_wake_hour(self, hour):
+        start, end = self.wake_hours
+        return start <= hour < end
+
+DEFAULT_CONFIG = ChannelConfig(None, None)
+
+def parse_timezone(value):
+    """'Asia/Tokyo' のような名前か '+09:00' 形式のオフセットを tzinfo にする (未指定は JST)"""
+    if not value: return JST
+    if value[0] in '+-':
+        sign = -1 if value[0] == '-' else 1
+        hours, _, minutes = value[1:].partition(':')
+        return datetime.timezone(sign * datetime.timedelta(hours=int(hours), minutes=int(minutes or 0)))
+    return ZoneInfo(value)
+
+def load_registry(channels_json, default_channel_id=None, default_sheet_id=None, default_db_path='hoyaoki.db'):
+    """チャンネルID -> ChannelConfig を返す
+
+    channels_json は [{"channel_id": ..., "sheet_id": ..., "timezone": "Asia/Tokyo", "day_start_hour": 4,
+    "wake_hours": [4, 18], "db_path": ..., "name": ...}, ...] の形の JSON 文字列。channel_id と sheet_id 以外は省略できる。
+    """
+    if not channels_json:
+        if default_channel_id is None:
+            raise ValueError("DISCORD_CHANNEL_ID or CHANNELS_JSON must be set.")
+        config = ChannelConfig(int(default_channel_id), default_sheet_id, default_db_path)
+        return {config.channel_id: config}
+
+    registry = {}
+    for entry in json.loads(channels_json):
+        channel_id = int(entry['channel_id'])
+        config = ChannelConfig(
+            channel_id,
+            entry['sheet_id'],
+            entry.get('db_path') or f"hoyaoki-{channel_id}.db",
+            timezone=parse_timezone(entry.get('timezone')),
+            day_start_hour=int(entry.get('day_start_hour', 4)),
+            wake_hours=[int(h) for h in entry.get('wake_hours', (4, 18))],
+            name=entry.get('name'),
+        )
+        if channel_id in registry:
+            raise ValueError(f"Duplicate channel_id in CHANNELS_JSON: {channel_id}")
+        # 起床の時間帯が1日の境目より前から始まると、その間の起床が前日の記録になってしまう。
+        # また就寝時刻は12時より前を日付を越えた就寝 (24時以降) として扱う (time_to_seconds / decode_seconds) ため、
+        # 起床の時間帯は12時をまたいでいなければならない (例えば [5, 11] だと11時台の就寝が35時台になる)
+        start, end = config.wake_hours
+        if not 0 <= config.day_start_hour <= start <= 12 <= end <= 24:
+            raise ValueError(f"Channel {channel_id} needs 0 <= day_start_hour <= wake_hours[0] <= 12 <= wake_hours[1] <= 24 "
+                             f"(got day_start_hour={config.day_start_hour}, wake_hours={list(config.wake_hours)})")
+        registry[channel_id] = config
+
+    # 同じシート・DBを2つのチャンネルで共有すると、互いの記録と取り込み位置を上書きしてしまう
+    for attr in ('sheet_id', 'db_path'):
+        values = [getattr(config, attr) for config in registry.values()]
+        duplicates = {v for v in values if values.count(v) > 1}
+        if duplicates:
+            raise ValueError(f"Each channel needs its own {attr}: {', '.join(sorted(duplicates))}")
+    return registry
@@ -0,0 +1,107 @@
+import datetime
+import re
+
+from timeutil import JST, parse_timestamp_smart, time_to_seconds
+
+# --- 累計データの時刻セルの読み書き ---
+# セルは save 時に isoformat() で書いたものがほとんどなので、正規表現での切り出しで読み、
+# 手入力・旧形式のセルのみ dateutil (parse_timestamp_smart) にフォールバックする
+_ISO = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?(Z|[+-]\d{2}:?\d{2})?$')
+_CLOCK = re.compile(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?$')  # コンパクト形式 "HH:MM:SS" (就寝は 24時以降あり)
+
+_TIMEZONES = {9 * 60: JST}  # UTCオフセット(分) -> timezone
+
+def get_timezone(offset_minutes):
+    tz = _TIMEZONES.get(offset_minutes)
+    if tz is None:
+        tz = _TIMEZONES[offset_minutes] = datetime.timezone(datetime.timedelta(minutes=offset_minutes))
+    return tz
+
+def _offset_minutes(suffix):
+    if suffix == 'Z': return 0
+    sign = -1 if suffix[0] == '-' else 1
+    digits = suffix[1:].replace(':', '')
+    return sign * (int(digits[:2]) * 60 + int(digits[2:]))
+
+_LOCAL_SUFFIXES = {}  # tz -> そのまま時・分・秒を読んでよいオフセット表記
+
+def _local_suffixes(tz):
+    """tz の時刻として書かれたとみなせる接尾辞 (固定オフセットのタイムゾーンのみ。夏時間のある地域は datetime を経由する)"""
+    suffixes = _LOCAL_SUFFIXES.get(tz)
+    if suffixes is None:
+        suffixes = {None}
+        if isinstance(tz, datetime.timezone):
+            minutes = int(tz.utcoffset(None).total_seconds()) // 60
+            sign = '-' if minutes < 0 else '+'
+            hh, mm = divmod(abs(minutes), 60)
+            suffixes |= {f"{sign}{hh:02d}:{mm:02d}", f"{sign}{hh:02d}{mm:02d}"}
+            if minutes == 0: suffixes.add('Z')
+        _LOCAL_SUFFIXES[tz] = suffixes
+    return suffixes
+
+def decode_timestamp(value, tz=JST):
+    """保存された時刻を tz (既定は JST) の datetime に変換する (読めなければ None)"""
+    if not value: return None
+    match = _ISO.match(str(value).strip())
+    if not match: return parse_timestamp_smart(value, tz)
+    year, month, day, hour, minute, second = (int(g) for g in match.groups()[:6])
+    microsecond = int(match.group(7).ljust(6, '0')) if match.group(7) else 0
+    # タイムゾーン無しは tz の時刻とみなす
+    if match.group(8) is None:
+        return datetime.datetime(year, month, day, hour, minute, second, microsecond, tzinfo=tz)
+    offset = _offset_minutes(match.group(8))
+    dt = datetime.datetime(year, month, day, hour, minute, second, microsecond, tzinfo=get_timezone(offset))
+    return dt if dt.tzinfo is tz else dt.astimezone(tz)
+
+def decode_seconds(value, kind, tz=JST):
+    """保存された時刻を time_to_seconds() と同じ秒数に変換する (読めなければ None)
+
+    isoformat 形式 (tz の時刻)・コンパクト形式は datetime を作らずに文字列から直接計算する。
+    """
+    if value is None or value == '': return None
+    if isinstance(value, int): return value
+    text = str(value).strip()
+    match = _CLOCK.match(text)
+    if match:
+        hour, minute, second = int(match.group(1)), int(match.group(2)), int(match.group(3) or 0)
+    else:
+        match = _ISO.match(text)
+        if match and match.group(8) in _local_suffixes(tz):
+            hour, minute, second = int(match.group(4)), int(match.group(5)), int(match.group(6))
+        else:
+            dt = decode_timestamp(text, tz)
+            return time_to_seconds(dt, is_sleep=kind == 'sleep') if dt else None
+    # 就寝時間 (18:00~03:59) の 0~3時は 24~27時として扱う (time_to_seconds と同じ)
+    if kind == 'sleep' and hour < 12:
+        hour += 24
+    return hour * 3600 + minute * 60 + second
+
+def encode_seconds(date_str, sec, compact=False, tz=JST):
+    """論理日付と秒数をセルの文字列にする。compact なら "HH:MM:SS"、それ以外は tz の時刻の isoformat()"""
+    if sec is None: return ""
+    if compact:
+        return f"{sec // 3600:02d}:{sec % 3600 // 60:02d}:{sec % 60:02d}"
+    midnight = datetime.datetime.combine(datetime.date.fromisoformat(date_str), datetime.time(), tz)
+    return (midnight + datetime.timedelta(seconds=sec)).isoformat()
+
+class RowCodec:
+    """累計データシートの1行 [ユーザー名, 日付, 起床時刻, 就寝時刻] と DailyRecords の相互変換
+
+    isoformat 形式の時刻はチャンネルのタイムゾーン tz で読み書きする。
+    """
+    def __init__(self, compact=False, tz=JST):
+        self.compact = compact
+        self.tz = tz
+
+    def encode_row(self, records, user_name, date_str):
+        return [
+            user_name,
+            date_str,
+            encode_seconds(date_str, records.get_seconds(user_name, date_str, 'wake'), self.compact, self.tz),
+            encode_seconds(date_str, records.get_seconds(user_name, date_str, 'sleep'), self.compact, self.tz),
+        ]
+
+    def decode_row(self, row):
+        """(ユーザー名, 日付, 起床秒数, 就寝秒数) を返す"""
+        row = list(row) + [''] * (4 - len(row))
+        return row[0], row[1], decode_seconds(row[2], 'wake', self.tz), decode_seconds(row[3], 'sleep', self.tz)
@@ -0,0 +1,136 @@
+import asyncio
+import collections
+import time
+
+from channels import DEFAULT_CONFIG
+from timeutil import extract_time_from_text, time_to_seconds
+
+# --- メッセージ取り込みパイプライン ---
+# 履歴の取得 → 先読み → 取り込み位置の更新 → bot除外・起床/就寝の分類 → 手動指定時刻の抽出 → その日の最小値への畳み込み
+# を非同期ジェネレーターでつなぎ、メッセージを溜め込まずに1件ずつ流す。on_message も同じ関数を同期的に使う。
+
+Observation = collections.namedtuple('Observation', ['user_name', 'user_id', 'date_str', 'kind', 'timestamp', 'content'])
+
+PREFETCH_SIZE = 200  # 先読みするメッセージ数 (Discord の履歴取得2ページ分)
+
+def user_name_of(author):
+    """記録に使うユーザー名 (表示名が無ければユーザー名)。discord.py の User には username 属性は無い"""
+    return author.global_name or author.name
+
+def classify_message(message, config=DEFAULT_CONFIG):
+    """メッセージを起床/就寝に分類する。bot の投稿は None"""
+    if message.author.bot: return None
+
+    # タイムゾーンの二重加算防止
+    timestamp = config.localize(message.created_at)
+
+    user_name = user_name_of(message.author)
+    # 1日の境目 (既定は朝4時) で日付を決定
+    date_str = config.logical_date(timestamp)
+    kind = 'wake' if config.is_wake_hour(timestamp.hour) else 'sleep'
+    return Observation(user_name, message.author.id, date_str, kind, timestamp, message.content)
+
+def apply_manual_time(observation, config=DEFAULT_CONFIG):
+    """本文に時刻の指定があれば起床時刻をそれに置き換える (起床のみ)"""
+    if observation.kind != 'wake': return observation
+    ex_h, ex_m = extract_time_from_text(observation.content)
+    if ex_h is not None and ex_m is not None:
+        if config.is_wake_hour(ex_h) and ex_m < 60:
+            return observation._replace(timestamp=observation.timestamp.replace(hour=ex_h, minute=ex_m, second=0, microsecond=0))
+    return observation
+
+def fold_observation(records, user_id_map, observation, aggregator=None):
+    """その日の最も早い記録であれば反映する。更新した場合は (ユーザー名, 日付) を返す"""
+    user_name, date_str, kind = observation.user_name, observation.date_str, observation.kind
+    user_id_map[user_name] = observation.user_id
+
+    existing_sec = records.get_seconds(user_name, date_str, kind)
+    new_sec = time_to_seconds(observation.timestamp, is_sleep=kind == 'sleep')
+    if existing_sec is None or new_sec < existing_sec:
+        records.set_seconds(user_name, date_str, kind, new_sec)
+        if aggregator is not None:
+            aggregator.replace(user_name, date_str, kind, existing_sec, new_sec)
+        return user_name, date_str
+    return None
+
+def apply_message(records, user_id_map, message, aggregator=None, config=DEFAULT_CONFIG):
+    """メッセージ1件を分類して反映する。更新した場合は (ユーザー名, 日付) を返す"""
+    observation = classify_message(message, config)
+    if observation is None: return None
+    return fold_observation(records, user_id_map, apply_manual_time(observation, config), aggregator)
+
+# --- パイプラインの各段 ---
+_END = object()
+
+async def prefetch(source, maxsize=PREFETCH_SIZE, stats=None):
+    """source の取得を別タスクで先行させ、ネットワーク待ちと後段の処理を重ねる (保持するのは最大 maxsize 件)
+
+    stats を渡すと、先読みが追いつかず後段が待たされた時間を stats['wait_sec'] に加える。
+    """
+    queue = asyncio.Queue(maxsize)
+
+    async def produce():
+        try:
+            async for item in source:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_END)
+
+    task = asyncio.get_running_loop().create_task(produce())
+    try:
+        while True:
+            if stats is not None and queue.empty():
+                start = time.perf_counter()
+                item = await queue.get()
+                stats['wait_sec'] += time.perf_counter() - start
+            else:
+                item = await queue.get()
+            if item is _END: break
+            if isinstance(item, Exception): raise item
+            yield item
+    finally:
+        task.cancel()
+
+async def observe(messages, callback):
+    """全てのメッセージ (bot を含む) を callback に通してからそのまま流す"""
+    async for message in messages:
+        callback(message)
+        yield message
+
+async def classify(messages, config, skip=None):
+    async for message in messages:
+        if skip is not None and skip(message): continue
+        observation = classify_message(message, config)
+        if observation is not None:
+            yield observation
+
+async def manual_time(observations, config):
+    async for observation in observations:
+        yield apply_manual_time(observation, config)
+
+async def run_pipeline(history, on_message_seen, fold, prefetch_size=PREFETCH_SIZE, stats=None, config=DEFAULT_CONFIG, skip=None):
+    """履歴を最後まで流し、fold(observation) で畳み込む。(メッセージ数, 更新数) を返す
+
+    日付の区切り・起床の時間帯・タイムゾーンは config (ChannelConfig) に従う。
+    skip(message) が真のメッセージは取り込み位置だけ進め、記録には使わない。
+    stats (dict) を渡すと、履歴の取得待ちの時間 wait_sec、全体の時間 total_sec、畳み込んだ記録数 observations を書き込む。
+    """
+    if stats is not None: stats.update(wait_sec=0.0, total_sec=0.0, observations=0)
+    start = time.perf_counter()
+    seen = 0
+    def count_and_forward(message):
+        nonlocal seen
+        seen += 1
+        on_message_seen(message)
+
+    changed = observations = 0
+    stream = manual_time(classify(observe(prefetch(history, prefetch_size, stats), count_and_forward), config, skip), config)
+    async for observation in stream:
+        observations += 1
+        if fold(observation): changed += 1
+    if stats is not None:
+        stats['total_sec'] = time.perf_counter() - start
+        stats['observations'] = observations
+    return seen, changed
@@ -0,0 +1,273 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# --- 計測 ---
+class LoopLagMonitor:
+    """一定間隔で sleep し、予定時刻からの遅れをイベントループの遅延として記録する
+
+    同期処理がループを止めていると遅延が大きくなるため、ブロッキング I/O の混入を検知できる。
+    """
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.last_lag = 0.0
+        self.max_lag = 0.0  # 実行中の分析のうち最も早く始まったもの以降の最大値 (/metrics 用)
+        self.windows = []
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    @contextmanager
+    def watch(self):
+        """with の間の最大遅延を {'max_lag': 秒} に記録する
+
+        分析は複数のチャンネルで並行して走るため、実行ごとに別の窓を持ち、互いの最大値を消さないようにする。
+        """
+        window = {'max_lag': 0.0}
+        if not self.windows:
+            self.max_lag = 0.0
+        self.windows.append(window)
+        try:
+            yield window
+        finally:
+            self.windows.remove(window)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - start - self.interval)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            for window in self.windows:
+                window['max_lag'] = max(window['max_lag'], self.last_lag)
+
+
+# --- 分析処理のフェーズ別計測 ---
+# span() で囲んだ区間の所要時間と件数 (メッセージ数・行数・API 呼び出し数・バイト数など) をフェーズごとに集計し、
+# /metrics で Prometheus のテキスト形式として公開する。
+# 現在の区間は contextvars で引き継ぐため、SheetsPublisher のスレッドで行われた API 呼び出しも呼び出し元の区間に数えられる。
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RUN_BUCKETS = (1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_current_run = contextvars.ContextVar('current_run', default=None)
+
+class Histogram:
+    """Prometheus のヒストグラム (上限ごとの件数・合計・件数)"""
+    def __init__(self, buckets=PHASE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """(上限, その上限以下の件数) を小さい順に返す。最後は '+Inf'"""
+        total = 0
+        for upper, count in zip(self.buckets, self.counts):
+            total += count
+            yield upper, total
+        yield '+Inf', self.count
+
+class Span:
+    __slots__ = ('phase', 'counts', 'error')
+
+    def __init__(self, phase, counts):
+        self.phase = phase
+        self.counts = counts
+        self.error = None
+
+    def add(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+class RunMetrics:
+    """フェーズごとの所要時間のヒストグラム・件数の累計と、チャンネルごとの直近の分析1回分の内訳を保持する
+
+    区間は入れ子にできる (例: load の中で初回の auth が走る)。その場合はそれぞれの区間に時間が計上される。
+    複数チャンネルの分析が並行して走っても、実行中の分析は contextvars で区別されるため内訳は混ざらない。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(Histogram)  # フェーズ -> Histogram
+        self.items = defaultdict(int)  # (フェーズ, 項目) -> 累計
+        self.errors = defaultdict(int)  # フェーズ -> エラー件数
+        self.runs = defaultdict(int)  # (チャンネル, 結果 ('success' / 'error')) -> 回数
+        self.run_durations = Histogram(RUN_BUCKETS)
+        self.last_runs = {}  # チャンネル -> 直近の分析の内訳
+
+    @contextmanager
+    def span(self, phase, **counts):
+        span = Span(phase, counts)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            self._record(span, time.perf_counter() - start)
+
+    def observe(self, phase, seconds, **counts):
+        """区間で囲めない処理 (別々に測った時間) を1つのフェーズとして記録する"""
+        self._record(Span(phase, counts), seconds)
+
+    def add(self, name, n=1):
+        """実行中の区間に件数を加える (区間の外では何もしない)"""
+        span = _current_span.get()
+        if span is not None: span.add(name, n)
+
+    @contextmanager
+    def run(self, channel=None):
+        """チャンネル1つの分析1回分を囲む。中で記録されたフェーズは last_runs[channel] に内訳として残る"""
+        current = {'started_at': time.time(), 'phases': {}}
+        token = _current_run.set(current)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            yield current
+            status = 'success'
+        finally:
+            _current_run.reset(token)
+            current['seconds'] = time.perf_counter() - start
+            current['status'] = status
+            with self.lock:
+                totals = defaultdict(int)
+                for stat in current['phases'].values():
+                    for name, n in stat['items'].items(): totals[name] += n
+                current['items'] = dict(totals)
+                self.runs[(channel, status)] += 1
+                self.run_durations.observe(current['seconds'])
+                self.last_runs[channel] = current
+
+    def _record(self, span, seconds):
+        with self.lock:
+            self.durations[span.phase].observe(seconds)
+            for name, n in span.counts.items():
+                self.items[(span.phase, name)] += n
+            if span.error is not None: self.errors[span.phase] += 1
+
+            current = _current_run.get()
+            if current is not None:
+                phase = current['phases'].setdefault(span.phase, {'seconds': 0.0, 'items': {}})
+                phase['seconds'] += seconds
+                for name, n in span.counts.items():
+                    phase['items'][name] = phase['items'].get(name, 0) + n
+
+    def last_run_items(self, *names, channel=None):
+        """チャンネルの直近の分析での項目の合計 (記録が無ければ 0)"""
+        with self.lock:
+            last_run = self.last_runs.get(channel)
+            items = last_run['items'] if last_run is not None else {}
+            return {name: items.get(name, 0) for name in names}
+
+    def summary(self, channel=None):
+        """チャンネルの直近の分析のフェーズ別所要時間 (ログ用)"""
+        with self.lock:
+            last_run = self.last_runs.get(channel)
+            if last_run is None: return "記録なし"
+            phases = last_run['phases']
+            return ", ".join(f"{phase}: {stat['seconds'] * 1000:.0f}ms" for phase, stat in phases.items())
+
+    def render(self, sheets_stats=None, loop_lag_monitor=None):
+        """Prometheus のテキスト形式 (0.0.4) で出力する"""
+        lines = []
+        with self.lock:
+            lines += _header('hoyaoki_phase_duration_seconds', 'histogram', "Duration of each analysis phase.")
+            for phase, histogram in sorted(self.durations.items()):
+                lines += _histogram_lines('hoyaoki_phase_duration_seconds', histogram, phase=phase)
+
+            lines += _header('hoyaoki_phase_items_total', 'counter', "Items processed per phase (messages, rows, API calls, bytes).")
+            for (phase, name), n in sorted(self.items.items()):
+                lines.append(_sample('hoyaoki_phase_items_total', n, phase=phase, item=name))
+
+            lines += _header('hoyaoki_phase_errors_total', 'counter', "Phases that ended with an exception.")
+            for phase, n in sorted(self.errors.items()):
+                lines.append(_sample('hoyaoki_phase_errors_total', n, phase=phase))
+
+            lines += _header('hoyaoki_runs_total', 'counter', "Completed analysis runs by channel and result.")
+            for (channel, status), n in sorted(self.runs.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+                lines.append(_sample('hoyaoki_runs_total', n, **_channel_label(channel), status=status))
+
+            lines += _header('hoyaoki_run_duration_seconds', 'histogram', "Duration of whole analysis runs.")
+            lines += _histogram_lines('hoyaoki_run_duration_seconds', self.run_durations)
+
+            last_runs = sorted(self.last_runs.items(), key=lambda item: str(item[0]))
+            if last_runs:
+                gauges = [
+                    ('hoyaoki_last_run_duration_seconds', "Duration of the last analysis run."),
+                    ('hoyaoki_last_run_timestamp_seconds', "Start time of the last analysis run."),
+                    ('hoyaoki_last_run_success', "1 if the last analysis run succeeded."),
+                    ('hoyaoki_last_run_phase_duration_seconds', "Per-phase duration in the last analysis run."),
+                    ('hoyaoki_last_run_phase_items', "Per-phase item counts in the last analysis run."),
+                    ('hoyaoki_last_run_items', "Item counts in the last analysis run, summed over phases (including retries and throttles)."),
+                ]
+                samples = defaultdict(list)
+                for channel, last_run in last_runs:
+                    labels = _channel_label(channel)
+                    samples['hoyaoki_last_run_duration_seconds'].append(_sample('hoyaoki_last_run_duration_seconds', last_run['seconds'], **labels))
+                    samples['hoyaoki_last_run_timestamp_seconds'].append(_sample('hoyaoki_last_run_timestamp_seconds', last_run['started_at'], **labels))
+                    samples['hoyaoki_last_run_success'].append(_sample('hoyaoki_last_run_success', int(last_run['status'] == 'success'), **labels))
+                    for phase, stat in last_run['phases'].items():
+                        samples['hoyaoki_last_run_phase_duration_seconds'].append(_sample('hoyaoki_last_run_phase_duration_seconds', stat['seconds'], **labels, phase=phase))
+                        for name, n in stat['items'].items():
+                            samples['hoyaoki_last_run_phase_items'].append(_sample('hoyaoki_last_run_phase_items', n, **labels, phase=phase, item=name))
+                    for name, n in sorted(last_run['items'].items()):
+                        samples['hoyaoki_last_run_items'].append(_sample('hoyaoki_last_run_items', n, **labels, item=name))
+                # 同じ名前の系列は1か所にまとめて出力する (Prometheus のテキスト形式の決まり)
+                for name, help_text in gauges:
+                    lines += _header(name, 'gauge', help_text)
+                    lines += samples[name]
+
+        if sheets_stats is not None:
+            for key, name, kind, help_text in (
+                ('calls', 'hoyaoki_sheets_requests_total', 'counter', "Google Sheets API requests by operation."),
+                ('errors', 'hoyaoki_sheets_errors_total', 'counter', "Google Sheets API requests that returned an error."),
+                ('total_sec', 'hoyaoki_sheets_request_seconds_total', 'counter', "Total time spent in Google Sheets API requests."),
+                ('max_sec', 'hoyaoki_sheets_request_max_seconds', 'gauge', "Slowest Google Sheets API request."),
+                ('sent_bytes', 'hoyaoki_sheets_sent_bytes_total', 'counter', "Request body bytes sent to the Google Sheets API."),
+                ('received_bytes', 'hoyaoki_sheets_received_bytes_total', 'counter', "Response body bytes received from the Google Sheets API."),
+            ):
+                lines += _header(name, kind, help_text)
+                for operation, stat in sorted(sheets_stats.items()):
+                    lines.append(_sample(name, stat[key], operation=operation))
+
+        if loop_lag_monitor is not None:
+            lines += _header('hoyaoki_event_loop_lag_seconds', 'gauge', "Latest event loop lag.")
+            lines.append(_sample('hoyaoki_event_loop_lag_seconds', loop_lag_monitor.last_lag))
+            lines += _header('hoyaoki_event_loop_max_lag_seconds', 'gauge', "Maximum event loop lag since the earliest running (or last) analysis run started.")
+            lines.append(_sample('hoyaoki_event_loop_max_lag_seconds', loop_lag_monitor.max_lag))
+        return "\n".join(lines) + "\n"
+
+def _channel_label(channel):
+    return {'channel': channel} if channel is not None else {}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sample(name, value, **labels):
+    label_text = ",".join(f'{key}="{_escape(v)}"' for key, v in labels.items())
+    return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+def _header(name, kind, help_text):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+def _histogram_lines(name, histogram, **labels):
+    lines = [_sample(f"{name}_bucket", count, **labels, le=upper) for upper, count in histogram.cumulative()]
+    lines.append(_sample(f"{name}_sum", histogram.sum, **labels))
+    lines.append(_sample(f"{name}_count", histogram.count, **labels))
+    return lines
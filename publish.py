@@ -0,0 +1,141 @@
+import datetime
+import hashlib
+import json
+import threading
+
+from timeutil import JST, seconds_to_time_str, format_delta_seconds
+
+# --- スプレッドシート更新ロジック ---
+# 各シートは値のグリッドと書式のリクエストに分けて作り、SheetViewPublisher が
+# 前回から変化した部分だけを1回の batch_update で送る。失敗時は例外をそのまま送出する (呼び出し側で記録する)
+
+def fingerprint(value):
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+def to_cell(value):
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+class SheetViewPublisher:
+    """シートごとに最後に書き込んだ値と書式の指紋を覚えておき、変化の無い書き込みを省く
+
+    値が変わっていなければ API を呼ばない。変わっていれば値 (updateCells) と、書式の指紋が変わった場合のみ書式を
+    1回の batch_update にまとめて送る。updateCells はシート全体を範囲にするため、グリッドの外に残った古い値も
+    同じリクエストで消え、clear() による一瞬の空白が生じない。指紋はプロセス内にのみ保持するので、再起動後の最初の1回は必ず書き込む。
+    updateCells はシートの行数・列数の外には書き込めないため、グリッドが収まらない場合は同じ batch_update の先頭でシートを広げる。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # シートID -> 値の指紋
+        self.layouts = {}  # シートID -> 書式の指紋
+        self.sizes = {}  # シートID -> (行数, 列数) (広げた後の大きさ。未記録ならワークシートの値を使う)
+
+    def publish(self, sheet, grid, layout, title=None):
+        """grid (行のリスト) を A1 から書き込む。title を渡すと、その行を先頭に付ける (指紋には含めない)
+
+        書き込んだ場合は True を返す。
+        """
+        values_fp, layout_fp = fingerprint(grid), fingerprint(layout)
+        with self.lock:
+            if self.values.get(sheet.id) == values_fp and self.layouts.get(sheet.id) == layout_fp:
+                return False
+            send_layout = self.layouts.get(sheet.id) != layout_fp
+            row_count, col_count = self.sizes.get(sheet.id) or (sheet.row_count, sheet.col_count)
+
+        rows = [title] + grid if title is not None else grid
+        requests = [{"updateCells": {
+            "range": {"sheetId": sheet.id},
+            "rows": [{"values": [to_cell(v) for v in row]} for row in rows],
+            "fields": "userEnteredValue",
+        }}]
+        height, width = len(rows), max((len(row) for row in rows), default=0)
+        if height > row_count or width > col_count:
+            row_count, col_count = max(height, row_count), max(width, col_count)
+            requests.insert(0, { "updateSheetProperties": { "properties": { "sheetId": sheet.id, "gridProperties": { "rowCount": row_count, "columnCount": col_count } }, "fields": "gridProperties.rowCount,gridProperties.columnCount" } })
+            # 広げた行・列にも書式が掛かるよう、書式も送り直す
+            send_layout = True
+        if send_layout: requests += layout
+        sheet.spreadsheet.batch_update({"requests": requests})
+
+        with self.lock:
+            self.values[sheet.id] = values_fp
+            self.layouts[sheet.id] = layout_fp
+            self.sizes[sheet.id] = (row_count, col_count)
+        return True
+
+RANKING_HEADERS = ['順位', 'ユーザー名', '今月の起床', '今月の就寝', '先月の起床', '先月の就寝', '変化(起床)', '累計起床', '累計日数']
+
+def render_ranking_rows(analysis_data):
+    """ランキングシートのヘッダーと行 (タイトル行を除く)"""
+    rows = [RANKING_HEADERS]
+    for index, user in enumerate(analysis_data):
+        rows.append([
+            index + 1,
+            user['userName'],
+            seconds_to_time_str(user['current_wake_avg']),
+            seconds_to_time_str(user['current_sleep_avg'], is_sleep=True),
+            seconds_to_time_str(user['previous_wake_avg']),
+            seconds_to_time_str(user['previous_sleep_avg'], is_sleep=True),
+            format_delta_seconds(user['delta_sec']),
+            seconds_to_time_str(user['overall_wake_avg']),
+            user['overall_count']
+        ])
+    return rows
+
+def ranking_layout(sheet_id):
+    """ランキングシートの書式 (行数に依存しないため、通常は初回のみ送られる)"""
+    return [
+        { "updateSheetProperties": { "properties": { "sheetId": sheet_id, "gridProperties": { "frozenRowCount": 2 } }, "fields": "gridProperties.frozenRowCount" } },
+        { "mergeCells": { "range": { "sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": 9 }, "mergeType": "MERGE_ALL" } },
+        { "repeatCell": { "range": { "sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1 }, "cell": { "userEnteredFormat": { "textFormat": { "bold": True, "fontSize": 12 }, "horizontalAlignment": "CENTER", "verticalAlignment": "MIDDLE" } }, "fields": "userEnteredFormat(textFormat,horizontalAlignment,verticalAlignment)" } },
+        { "repeatCell": { "range": { "sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 2 }, "cell": { "userEnteredFormat": { "backgroundColor": { "red": 0.2, "green": 0.2, "blue": 0.2 }, "textFormat": { "foregroundColor": { "red": 1, "green": 1, "blue": 1 }, "bold": True }, "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)" } },
+        { "repeatCell": { "range": { "sheetId": sheet_id, "startRowIndex": 2 }, "cell": { "userEnteredFormat": { "verticalAlignment": "MIDDLE" } }, "fields": "userEnteredFormat.verticalAlignment" } },
+        { "repeatCell": { "range": { "sheetId": sheet_id, "startRowIndex": 2, "startColumnIndex": 0, "endColumnIndex": 1 }, "cell": { "userEnteredFormat": { "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat.horizontalAlignment" } },
+        { "repeatCell": { "range": { "sheetId": sheet_id, "startRowIndex": 2, "startColumnIndex": 2, "endColumnIndex": 9 }, "cell": { "userEnteredFormat": { "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat.horizontalAlignment" } },
+        { "updateDimensionProperties": { "range": { "sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": 1 }, "properties": { "pixelSize": 40 }, "fields": "pixelSize" } },
+        { "updateDimensionProperties": { "range": { "sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": 1, "endIndex": 2 }, "properties": { "pixelSize": 120 }, "fields": "pixelSize" } },
+        { "updateDimensionProperties": { "range": { "sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": 2, "endIndex": 9 }, "properties": { "pixelSize": 75 }, "fields": "pixelSize" } },
+    ]
+
+def update_spreadsheet(sheet, analysis_data, views, tz=JST):
+    """ランキングシートを更新する。順位表が前回と同じならタイトルの最終更新時刻 (tz の時刻) も書き換えない"""
+    if not analysis_data: return False
+    now = datetime.datetime.now(tz)
+    title = [f"起床時刻ランキング (最終更新: {now.strftime('%Y/%m/%d %H:%M')})"]
+    return views.publish(sheet, render_ranking_rows(analysis_data), ranking_layout(sheet.id), title=title)
+
+def render_monthly_average_rows(aggregator):
+    """月別平均推移シートのヘッダーと行を作る (共有中のデータを読むためイベントループ上で呼ぶこと)"""
+    all_year_months = sorted(ym.replace('-','/') for ym in aggregator.year_months)
+    if not all_year_months: return [], []
+
+    headers = ['ユーザー名']
+    for ym in all_year_months:
+        headers.append(f"{ym} 起床")
+        # 2026年5月以降のみ就寝列を追加
+        if ym >= "2026/05":
+            headers.append(f"{ym} 就寝")
+    
+    rows = []
+    for user in sorted(aggregator.users()):
+        row = [user]
+        for ym in all_year_months:
+            key = ym.replace('/','-')
+            row.append(seconds_to_time_str(aggregator.mean(user, 'wake', key)))
+            
+            if ym >= "2026/05":
+                row.append(seconds_to_time_str(aggregator.mean(user, 'sleep', key), is_sleep=True))
+        rows.append(row)
+    return headers, rows
+
+def monthly_average_layout(sheet_id):
+    return [
+        { "updateSheetProperties": { "properties": { "sheetId": sheet_id, "gridProperties": { "frozenRowCount": 1, "frozenColumnCount": 1 } }, "fields": "gridProperties.frozenRowCount,gridProperties.frozenColumnCount" } },
+        { "repeatCell": { "range": { "sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1 }, "cell": { "userEnteredFormat": { "backgroundColor": { "red": 0.2, "green": 0.2, "blue": 0.2 }, "textFormat": { "foregroundColor": { "red": 1, "green": 1, "blue": 1 }, "bold": True }, "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)" } },
+        { "repeatCell": { "range": { "sheetId": sheet_id, "startRowIndex": 1, "startColumnIndex": 1 }, "cell": { "userEnteredFormat": { "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat.horizontalAlignment" } },
+    ]
+
+def update_monthly_average_sheet(sheet, headers, rows, views):
+    if not headers: return False
+    return views.publish(sheet, [headers] + rows, monthly_average_layout(sheet.id))
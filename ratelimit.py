@@ -0,0 +1,147 @@
+import random
+import threading
+import time
+
+# --- API の呼び出し予算と再試行 ---
+# Sheets API の読み取り・書き込みの毎分の上限に合わせてトークンバケットで呼び出しを均し、
+# 一時的なエラー (429 / 5xx / 通信エラー) は指数バックオフ (ジッター付き) で再試行する。
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+def error_status(error):
+    """HTTP ステータスを返す (gspread の APIError は response.status_code、discord.py の HTTPException は status)"""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None: status = getattr(error, 'status', None)
+    return status if isinstance(status, int) else None
+
+def is_retryable(error):
+    status = error_status(error)
+    if status is not None: return status in RETRYABLE_STATUS
+    # requests の例外 (RequestException) と接続・タイムアウトのエラーは OSError の派生
+    return isinstance(error, OSError)
+
+def retry_after(error):
+    """Retry-After ヘッダーの秒数 (無ければ None)"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try: return float(headers.get('Retry-After'))
+    except (TypeError, ValueError): return None
+
+class TokenBucket:
+    """毎分 per_minute 回までの呼び出しを許すトークンバケット
+
+    初めの burst 回はすぐに通し、以降は一定の間隔に均す。任意の60秒間の合計が per_minute を超えないよう、
+    補充の速さは (per_minute - burst) / 60 回/秒 にしている。
+    """
+    def __init__(self, per_minute, burst=None):
+        self.burst = burst if burst is not None else max(1, per_minute // 4)
+        self.rate = max(per_minute - self.burst, 1) / 60
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取る。足りなければ補充されるまで (呼び出し元のスレッドで) 待ち、待った秒数を返す"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class Backoff:
+    """指数バックオフ (full jitter)。attempt 回目の失敗の後は 0〜min(cap, base * 2**attempt) 秒待つ"""
+    def __init__(self, max_attempts=5, base=1.0, cap=32.0, retryable=is_retryable):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.retryable = retryable
+
+    def delay(self, attempt, error=None):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        # 429 で Retry-After が指定されていればそれより早くは再試行しない
+        after = retry_after(error) if error is not None else None
+        return max(delay, after) if after is not None else delay
+
+    def should_retry(self, attempt, error):
+        return attempt + 1 < self.max_attempts and self.retryable(error)
+
+class RequestBudget:
+    """Sheets API の呼び出し予算 (読み取り・書き込みのバケット) と再試行をまとめたもの
+
+    metrics (RunMetrics) を渡すと、待たされた回数 (sheets_throttled)・待った時間 (sheets_throttled_ms)・
+    再試行の回数 (sheets_retries)・一連の処理をやり直した回数 (sheets_resumes) を実行中の計測区間に加える。
+    """
+    def __init__(self, read_per_minute=60, write_per_minute=60, backoff=None, metrics=None):
+        self.buckets = {'read': TokenBucket(read_per_minute), 'write': TokenBucket(write_per_minute)}
+        self.backoff = backoff or Backoff()
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.local = threading.local()  # run_resumable() の実行中かどうか (スレッドごと)
+        self.stats = {'throttled': 0, 'throttled_sec': 0.0, 'retries': 0, 'resumes': 0}
+
+    def call(self, kind, fn, idempotent=True):
+        """kind ('read' / 'write') の予算を使って fn() を呼ぶ。冪等な呼び出しは一時的なエラーで再試行する
+
+        run_resumable() の中では再試行せずにそのまま失敗させる (やり直しは外側で行うため、二重に再試行すると
+        試行回数が max_attempts の2乗になり、その間ずっと保存のロックを握ったままになる)。
+        """
+        retry = idempotent and not getattr(self.local, 'resuming', False)
+        attempt = 0
+        while True:
+            self.throttle(kind)
+            try:
+                return fn()
+            except Exception as e:
+                if not retry or not self.backoff.should_retry(attempt, e): raise
+                self._count('retries', 'sheets_retries')
+                time.sleep(self.backoff.delay(attempt, e))
+                attempt += 1
+
+    def run_resumable(self, fn, recover):
+        """冪等でない一連の呼び出し fn() を実行する
+
+        一時的なエラーで失敗した場合は待ってから recover() でシートの状態を確かめ直し、fn() を続きからやり直す。
+        fn() の中の個々の呼び出しは call() で再試行されない (recover() の読み取りは通常どおり再試行される)。
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._without_retries(fn)
+            except Exception as e:
+                if not self.backoff.should_retry(attempt, e): raise
+                self._count('resumes', 'sheets_resumes')
+                time.sleep(self.backoff.delay(attempt, e))
+                recover()
+                attempt += 1
+
+    def _without_retries(self, fn):
+        outer, self.local.resuming = getattr(self.local, 'resuming', False), True
+        try:
+            return fn()
+        finally:
+            self.local.resuming = outer
+
+    def throttle(self, kind):
+        waited = self.buckets[kind].acquire()
+        if waited:
+            with self.lock:
+                self.stats['throttled'] += 1
+                self.stats['throttled_sec'] += waited
+            if self.metrics is not None:
+                self.metrics.add('sheets_throttled')
+                self.metrics.add('sheets_throttled_ms', int(waited * 1000))
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def _count(self, key, item):
+        with self.lock:
+            self.stats[key] += 1
+        if self.metrics is not None: self.metrics.add(item)
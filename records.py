@@ -0,0 +1,89 @@
+import datetime
+from array import array
+
+# --- 累計データのメモリ上の表現 ---
+USER_SLOTS = 1 << 20  # 行索引のキー (日付序数 * USER_SLOTS + ユーザー添字) 用
+
+def month_code(date_str):
+    """'YYYY-MM-DD' → 年*12 + (月-1)"""
+    return int(date_str[:4]) * 12 + int(date_str[5:7]) - 1
+
+def month_code_to_str(code):
+    return f"{code // 12}-{code % 12 + 1:02d}"
+
+class DailyRecords:
+    """ユーザー・論理日付ごとの起床/就寝時刻を列ごとの配列で保持する
+
+    時刻は time_to_seconds() と同じ秒数 (就寝の 0~3時は 24~27時) で持つ。
+    ユーザー名は添字に置き換えて保持する。記録の無い時刻は -1。
+    """
+    KINDS = ('wake', 'sleep')
+
+    def __init__(self):
+        self.user_names = []  # 添字 -> ユーザー名
+        self.user_index = {}  # ユーザー名 -> 添字
+        self.user_col = array('i')
+        self.day_col = array('i')  # 日付の序数 (date.toordinal())
+        self.month_col = array('i')  # month_code()
+        self.wake_col = array('i')
+        self.sleep_col = array('i')
+        self.row_index = {}  # 日付序数 * USER_SLOTS + ユーザー添字 -> 行番号
+
+    def __len__(self):
+        return len(self.user_col)
+
+    def _column(self, kind):
+        return self.wake_col if kind == 'wake' else self.sleep_col
+
+    def _row(self, user_name, date_str, create=False):
+        user = self.user_index.get(user_name)
+        if user is None:
+            if not create: return None
+            user = self.user_index[user_name] = len(self.user_names)
+            self.user_names.append(user_name)
+        day = datetime.date.fromisoformat(date_str).toordinal()
+        key = day * USER_SLOTS + user
+        row = self.row_index.get(key)
+        if row is None and create:
+            row = self.row_index[key] = len(self.user_col)
+            self.user_col.append(user)
+            self.day_col.append(day)
+            self.month_col.append(month_code(date_str))
+            self.wake_col.append(-1)
+            self.sleep_col.append(-1)
+        return row
+
+    def get_seconds(self, user_name, date_str, kind):
+        row = self._row(user_name, date_str)
+        if row is None: return None
+        sec = self._column(kind)[row]
+        return None if sec < 0 else sec
+
+    def set_seconds(self, user_name, date_str, kind, sec):
+        row = self._row(user_name, date_str, create=True)
+        self._column(kind)[row] = sec
+
+    def rows(self):
+        """(ユーザー名, 日付) を挿入順に返す"""
+        for user, day in zip(self.user_col, self.day_col):
+            yield self.user_names[user], datetime.date.fromordinal(day).isoformat()
+
+    def users(self):
+        return list(self.user_names)
+
+    def recorded_days(self, kind):
+        """{ユーザー名: 記録のある日付の序数 (昇順)}"""
+        days = {}
+        for user, day, sec in zip(self.user_col, self.day_col, self._column(kind)):
+            if sec >= 0: days.setdefault(user, []).append(day)
+        return {self.user_names[user]: sorted(user_days) for user, user_days in days.items()}
+
+    # --- 集計 ---
+    def groupby_month(self, kind):
+        """{(ユーザー名, 'YYYY-MM'): (合計秒数, 件数)} を返す"""
+        groups = {}
+        for user, month, sec in zip(self.user_col, self.month_col, self._column(kind)):
+            if sec < 0: continue
+            total, count = groups.get((user, month), (0, 0))
+            groups[(user, month)] = (total + sec, count + 1)
+        return {(self.user_names[user], month_code_to_str(month)): value for (user, month), value in groups.items()}
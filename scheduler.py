@@ -0,0 +1,140 @@
+import asyncio
+import datetime
+import threading
+import uuid
+from collections import OrderedDict
+
+# --- ジョブスケジューラ ---
+class Job:
+    def __init__(self, kind, key, options):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key  # 対象 (チャンネルID など)。同じ key のジョブは同時に走らない
+        self.options = dict(options)
+        self.status = 'queued'  # queued → running → done / failed
+        self.requests = 1  # まとめられた要求の数
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.waiters = []  # イベントループ上の Future (wait() で追加)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'key': self.key,
+            'status': self.status,
+            'requests': self.requests,
+            'options': self.options,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'error': self.error,
+        }
+
+class JobScheduler:
+    """asyncio 上で動くジョブスケジューラ
+
+    同じ種類・同じ対象 (key) の未実行ジョブは1つにまとめ (オプションは OR で合成)、
+    最大 concurrency 個のワーカーで並行して実行する。同じ key のジョブは同時には走らない
+    (同じシート・同じ取り込み状態を2つのジョブが同時に触らないようにするため)。
+    Flask のスレッドからは submit_threadsafe() で登録し、call_soon_threadsafe でループを即座に起こすためポーリングは不要。
+    """
+    def __init__(self, handler, concurrency=1, history_size=100):
+        self.handler = handler  # async def handler(job)
+        self.concurrency = concurrency
+        self.history_size = history_size
+        self.jobs = OrderedDict()  # id -> Job (直近 history_size 件)
+        self.pending = OrderedDict()  # (kind, key) -> 未実行の Job
+        self.running = set()  # 実行中のジョブの key
+        self.lock = threading.Lock()  # jobs / pending / running は Flask のスレッドからも触るため
+        self.loop = None
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        if any(not task.done() for task in self.tasks): return
+        self.loop = asyncio.get_running_loop()
+        self.tasks = [self.loop.create_task(self._worker()) for _ in range(self.concurrency)]
+        if self.pending: self.wakeup.set()
+
+    def submit(self, kind, key=None, **options):
+        """ジョブを登録する (イベントループ上から呼ぶ)。同じ種類・対象の未実行ジョブがあればそれを返す"""
+        job = self._enqueue(kind, key, options)
+        self.wakeup.set()
+        return job
+
+    def submit_threadsafe(self, kind, key=None, **options):
+        """別スレッド (Flask) からジョブを登録する"""
+        job = self._enqueue(kind, key, options)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    async def wait(self, job):
+        """ジョブの完了を待つ。失敗した場合は例外を送出する"""
+        if job.status == 'done': return
+        if job.status == 'failed': raise RuntimeError(job.error)
+        future = asyncio.get_running_loop().create_future()
+        job.waiters.append(future)
+        await future
+
+    def _enqueue(self, kind, key, options):
+        with self.lock:
+            job = self.pending.get((kind, key))
+            if job is not None:
+                job.requests += 1
+                for name, value in options.items():
+                    job.options[name] = job.options.get(name) or value
+                return job
+            job = Job(kind, key, options)
+            self.pending[(kind, key)] = job
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history_size:
+                self.jobs.popitem(last=False)
+            return job
+
+    def _take(self):
+        """実行できるジョブ (同じ key のジョブが実行中でないもの) を登録順に1つ取り出す"""
+        with self.lock:
+            for pending_key, job in self.pending.items():
+                if job.key in self.running: continue
+                del self.pending[pending_key]
+                self.running.add(job.key)
+                job.status = 'running'
+                job.started_at = datetime.datetime.now(datetime.timezone.utc)
+                return job
+            return None
+
+    async def _worker(self):
+        while True:
+            job = self._take()
+            if job is None:
+                # 待っている全てのワーカーが起き、それぞれ取り出しを試みる
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            try:
+                await self.handler(job)
+            except Exception as e:
+                print(f"error: {e}")
+                # メッセージの無い例外でも失敗と分かるよう、その場合は repr を残す
+                job.error = str(e) or repr(e)
+                job.status = 'failed'
+            else:
+                job.status = 'done'
+            job.finished_at = datetime.datetime.now(datetime.timezone.utc)
+            with self.lock:
+                self.running.discard(job.key)
+            # 同じ key の次のジョブを待っているワーカーを起こす
+            self.wakeup.set()
+            for future in job.waiters:
+                if future.done(): continue
+                if job.status == 'failed': future.set_exception(RuntimeError(job.error))
+                else: future.set_result(None)
@@ -1,29 +1,52 @@
 import discord
 from discord.ext import commands, tasks
-from flask import Flask, request
-from threading import Thread
+from flask import Flask, request, jsonify, Response
+from threading import Thread, Lock
 import os
-import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from collections import defaultdict
-import datetime
-from dateutil import parser
 import requests
 import json
 import asyncio
+import aiohttp
 from functools import wraps
-import queue
-import re
+from timeutil import seconds_to_time_str
+from channels import load_registry
+from storage import SheetsHistoryStore, SqliteHistoryStore
+from codec import RowCodec
+from sheets import SheetsSession, SheetsPublisher, is_stale_sheet_error
+from metrics import LoopLagMonitor, RunMetrics
+from ratelimit import Backoff, RequestBudget, is_retryable
+from aggregation import MonthlyAggregator, build_ranking
+from records import DailyRecords
+from scheduler import JobScheduler
+from ingest import apply_message, fold_observation, run_pipeline, user_name_of
+from stats import StatsCache, analysis_period, build_stats, find_user, format_user_stats
+from publish import SheetViewPublisher, update_spreadsheet, render_monthly_average_rows, update_monthly_average_sheet
 
 # --- 環境変数設定 ---
 BOT_TOKEN = os.environ.get('DISCORD_TOKEN')
-TARGET_CHANNEL_ID = int(os.environ.get('DISCORD_CHANNEL_ID'))
+TARGET_CHANNEL_ID = os.environ.get('DISCORD_CHANNEL_ID')  # CHANNELS_JSON が無い場合に追跡する1チャンネル
 SHEET_ID = os.environ.get('SHEET_ID')
+CHANNELS_JSON = os.environ.get('CHANNELS_JSON')  # 複数チャンネルを追跡する場合の登録簿 (JSON、形式は README 参照)
 TRIGGER_SECRET = os.environ.get('TRIGGER_SECRET')
-MESSAGE_LIMIT = int(os.environ.get('MESSAGE_LIMIT', 2000))
+MESSAGE_LIMIT = int(os.environ.get('MESSAGE_LIMIT', 2000))  # 初回バックフィル時に遡る件数
 PORT = int(os.environ.get('PORT', 8080))
+FLUSH_INTERVAL = int(os.environ.get('FLUSH_INTERVAL', 60))  # 書き込みバッファを保存する間隔 (秒)
+FLUSH_BATCH_SIZE = int(os.environ.get('FLUSH_BATCH_SIZE', 50))  # この件数の変更が溜まったら間隔を待たずに保存
+HISTORY_BACKEND = os.environ.get('HISTORY_BACKEND', 'sqlite')  # 累計データの保存先: 'sqlite' または 'sheets'
+HISTORY_DB_PATH = os.environ.get('HISTORY_DB_PATH', 'hoyaoki.db')
+EXPORT_INTERVAL = int(os.environ.get('EXPORT_INTERVAL', 300))  # SQLite の変更をシートへ反映する間隔 (秒)
+SHEET_TIME_FORMAT = os.environ.get('SHEET_TIME_FORMAT', 'iso')  # 累計データシートの時刻の書式: 'iso' または 'compact' ("HH:MM:SS")
+SHEETS_WORKERS = int(os.environ.get('SHEETS_WORKERS', 4))  # Sheets I/O 用スレッド数
+SHEETS_READ_PER_MINUTE = int(os.environ.get('SHEETS_READ_PER_MINUTE', 60))  # Sheets API の読み取りの毎分の上限 (ユーザーあたりの既定の割り当て)
+SHEETS_WRITE_PER_MINUTE = int(os.environ.get('SHEETS_WRITE_PER_MINUTE', 60))  # Sheets API の書き込みの毎分の上限
+API_MAX_ATTEMPTS = int(os.environ.get('API_MAX_ATTEMPTS', 5))  # 一時的なエラー時の最大試行回数
+STATS_TTL = int(os.environ.get('STATS_TTL', 60))  # 成績表のキャッシュの有効期間 (秒)。新しい取り込みがあれば期間内でも作り直す
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', 4))  # 同時に分析・取り込みするチャンネル数の上限
+
+# チャンネルID -> ChannelConfig (各チャンネルのシート・DB・日付の区切り・起床の時間帯・タイムゾーン)
+CHANNELS = load_registry(CHANNELS_JSON, TARGET_CHANNEL_ID, SHEET_ID, HISTORY_DB_PATH)
 
-analysis_queue = queue.Queue()
 app = Flask('')
 
 # --- Flask (Webサーバー) ---
@@ -39,228 +62,316 @@ def keep_alive():
     t.start()
 
 # --- Google Sheets 接続設定 ---
-def get_spreadsheet():
+def load_google_credentials():
     creds_json_str = os.environ.get('GOOGLE_CREDENTIALS_JSON')
     if not creds_json_str:
         raise ValueError("GOOGLE_CREDENTIALS_JSON is not set.")
     creds_dict = json.loads(creds_json_str)
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-    return client.open_by_key(SHEET_ID)
-
-def get_or_create_worksheet(spreadsheet, title):
-    try:
-        return spreadsheet.worksheet(title)
-    except gspread.WorksheetNotFound:
-        return spreadsheet.add_worksheet(title=title, rows="1000", cols="20")
-
-# --- 時刻計算・フォーマット関数 ---
-def time_to_seconds(dt, is_sleep=False):
-    if dt is None: return None
-    h = dt.hour
-    # 就寝時間 (18:00~03:59) の平均計算のため、0~3時を24~27時として扱う
-    if is_sleep and h < 12:
-        h += 24
-    return h * 3600 + dt.minute * 60 + dt.second
-
-def seconds_to_time_str(seconds, is_sleep=False):
-    if seconds is None: return "--:--"
-    h = int(seconds // 3600)
-    m = int((seconds % 3600) // 60)
-    if is_sleep and h >= 24:
-        h -= 24
-    return f"{h:02d}:{m:02d}"
-
-def format_delta_seconds(seconds):
-    if seconds is None: return "N/A"
-    total_minutes = round(seconds / 60)
-    sign = "+" if total_minutes >= 0 else "-"
-    return f"{sign}{abs(total_minutes)}分"
-
-def parse_timestamp_smart(timestamp_str):
-    if not timestamp_str: return None
-    try:
-        dt = parser.parse(str(timestamp_str))
-        if dt.tzinfo is None:
-             dt = dt.replace(tzinfo=datetime.timezone(datetime.timedelta(hours=9)))
-        else:
-             dt = dt.astimezone(datetime.timezone(datetime.timedelta(hours=9)))
-        return dt
-    except Exception:
-        return None
-
-def extract_time_from_text(text):
-    match = re.search(r'(\d{1,2})[:：](\d{2})', text)
-    if match: return int(match.group(1)), int(match.group(2))
-    match = re.search(r'(\d{1,2})時(?:(\d{1,2})分)?', text)
-    if match: return int(match.group(1)), int(match.group(2) or 0)
-    match = re.search(r'(\d{1,2})時半', text)
-    if match: return int(match.group(1)), 30
-    return None, None
-
-# --- データ読み書きロジック ---
-def load_historical_data(worksheet):
-    try: header_row = worksheet.row_values(1)
-    except Exception: header_row = []
-
-    expected_headers = ['ユーザー名', '日付', '起床時刻', '就寝時刻']
-    
-    if not header_row or header_row[0] != 'ユーザー名':
-        worksheet.append_row(expected_headers)
-    elif len(header_row) == 3 and header_row[2] == 'タイムスタンプ':
-        print("⚠️ 旧形式のデータを検出。起床時刻へのマイグレーションを実行します...")
-        all_values = worksheet.get_all_values()
-        worksheet.clear()
-        new_values = [expected_headers]
-        for row in all_values[1:]:
-            if len(row) >= 3: new_values.append([row[0], row[1], row[2], ""])
-        worksheet.update('A1', new_values)
-        print("✅ マイグレーション完了。")
-    
-    records = worksheet.get_all_records()
-    user_daily_data = defaultdict(lambda: defaultdict(dict))
-    
-    for record in records:
-        try:
-            user_name = record.get('ユーザー名')
-            date_str = record.get('日付')
-            wake_dt = parse_timestamp_smart(record.get('起床時刻', ''))
-            sleep_dt = parse_timestamp_smart(record.get('就寝時刻', ''))
-            
-            if not user_name or not date_str: continue
-            if wake_dt: user_daily_data[user_name][date_str]['wake'] = wake_dt
-            if sleep_dt: user_daily_data[user_name][date_str]['sleep'] = sleep_dt
-        except Exception:
-            continue
-
-    return user_daily_data
-
-def save_historical_data(worksheet, user_daily_data):
-    worksheet.clear()
-    headers = ['ユーザー名', '日付', '起床時刻', '就寝時刻']
-    rows = [headers]
-    for user_name, daily in user_daily_data.items():
-        for date_str, times in daily.items():
-            w = times.get('wake')
-            s = times.get('sleep')
-            rows.append([user_name, date_str, w.isoformat() if w else "", s.isoformat() if s else ""])
-    worksheet.update('A1', rows)
-
-# --- 分析メインロジック ---
-async def perform_analysis():
-    print("perform_analysis...")
-    
-    spreadsheet = get_spreadsheet()
-    db_sheet = get_or_create_worksheet(spreadsheet, "累計データ")
-    user_daily_data = load_historical_data(db_sheet)
-
-    target_channel = bot.get_channel(TARGET_CHANNEL_ID)
-    if not target_channel:
-        return None, None, [], [], "Channel not found."
-
-    new_messages = []
-    async for message in target_channel.history(limit=MESSAGE_LIMIT, oldest_first=False):
-        new_messages.append(message)
-
-    user_id_map = {}
-    JST = datetime.timezone(datetime.timedelta(hours=9))
-    
-    for message in new_messages:
-        if message.author.bot: continue
-        
-        # タイムゾーンの二重加算防止
-        if message.created_at.tzinfo is None:
-            timestamp_jst = message.created_at.replace(tzinfo=datetime.timezone.utc).astimezone(JST)
+    return ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+
+# 分析処理のフェーズ別の所要時間・件数 (/metrics で公開)
+run_metrics = RunMetrics()
+# Sheets API の呼び出しは全て割り当ての範囲に均し、一時的なエラーは再試行する (割り当てはサービスアカウント単位のため全チャンネルで共有)
+sheets_budget = RequestBudget(SHEETS_READ_PER_MINUTE, SHEETS_WRITE_PER_MINUTE, Backoff(API_MAX_ATTEMPTS), metrics=run_metrics)
+# 認証済みクライアントはプロセス全体で、ワークシートのハンドルはスプレッドシートごとに使い回す
+sheets_session = SheetsSession(load_google_credentials, metrics=run_metrics, budget=sheets_budget)
+# Discord の 429 は discord.py が待って再送するため、ここでは履歴の取得が途切れた場合の取り直しのみ行う
+discord_backoff = Backoff(API_MAX_ATTEMPTS, retryable=lambda e: isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)) or is_retryable(e))
+# Sheets・SQLite への I/O はイベントループを止めないよう専用のスレッドプールで実行する
+sheets_publisher = SheetsPublisher(max_workers=SHEETS_WORKERS)
+loop_lag_monitor = LoopLagMonitor()
+
+# --- メッセージ取り込みロジック ---
+class IngestState:
+    """on_message で逐次取り込んだ累計データをメモリ上に保持し、シートへの書き込みはバッファしてまとめて行う"""
+    def __init__(self, config):
+        self.config = config  # 日付の区切り・起床の時間帯・タイムゾーン
+        self.records = None  # DailyRecords (未読み込みの間は None)
+        self.aggregator = None  # records と同時に更新される月別集計
+        self.store = None
+        self.sheet_view = None  # SQLite 使用時のエクスポート先
+        self.watermark = None
+        self.pending = set()  # 未保存の (ユーザー名, 日付)
+        self.watermark_dirty = False
+        self.caught_up = False  # 切断以降の履歴を追いかけ終えたか (終えるまで on_message では取り込み位置を進めない)
+        self.disconnects = 0  # 追いかけの最中に切断された場合に caught_up を立てないためのもの
+        self.version = 0  # メモリ上のデータが変わるたびに増える (成績表のキャッシュの無効化用)
+        self.lock = asyncio.Lock()  # メモリ上のデータの読み込み・取り込み用
+        self.flush_lock = asyncio.Lock()  # 保存の順序を保つためのもの (保存中も取り込みは止めない)
+
+    @property
+    def loaded(self):
+        return self.records is not None
+
+    def advance_watermark(self, message):
+        if self.watermark['last_message_id'] is None or message.id > self.watermark['last_message_id']:
+            self.watermark['last_message_id'] = message.id
+            self.watermark['last_message_at'] = message.created_at.isoformat()
+            self.watermark_dirty = True
+
+    def fold(self, observation):
+        changed = fold_observation(self.records, self.watermark['user_ids'], observation, self.aggregator)
+        if changed:
+            self.pending.add(changed)
+            self.version += 1
+        return changed
+
+    def ingest(self, message):
+        """on_message で受け取ったメッセージを取り込む
+
+        取り込み位置を進めるのは、切断以降の履歴を追いかけ終えた後 (caught_up) のみ。切断中に受け取れなかった
+        メッセージは、それより後の投稿で取り込み位置を越されると二度と取得されないため。
+        追いかけ終えていれば、日次トリガーの追いかけは前回の投稿以降の差分だけで済む。
+        """
+        changed = apply_message(self.records, self.watermark['user_ids'], message, self.aggregator, self.config)
+        if changed:
+            self.pending.add(changed)
+            self.version += 1
+        if self.caught_up:
+            self.advance_watermark(message)
+
+    def take_pending(self):
+        """未保存の変更をスナップショットとして取り出す。書き込みはスレッドで行うため、共有中のデータは渡さない"""
+        keys, self.pending = self.pending, set()
+        snapshot = DailyRecords()
+        for user_name, date_str in keys:
+            for kind in DailyRecords.KINDS:
+                sec = self.records.get_seconds(user_name, date_str, kind)
+                if sec is not None: snapshot.set_seconds(user_name, date_str, kind, sec)
+        watermark = dict(self.watermark, user_ids=dict(self.watermark['user_ids']))
+        self.watermark_dirty = False
+        return keys, snapshot, watermark
+
+    def restore_pending(self, keys):
+        """保存に失敗した変更をバッファに戻す"""
+        self.pending |= keys
+        self.watermark_dirty = True
+
+# --- チャンネルごとの状態 ---
+class ChannelTracker:
+    """追跡するチャンネル1つ分の取り込み状態・保存先・シートの書き込み状態
+
+    チャンネルごとに別のスプレッドシート・SQLite ファイル・ロックを使うため、
+    あるチャンネルの分析が失敗したり API を待ったりしていても、他のチャンネルの取り込みと分析は止まらない。
+    """
+    def __init__(self, config):
+        self.config = config
+        self.state = IngestState(config)
+        self.sheets = sheets_session.open(config.sheet_id)
+        # ランキング・月別平均推移シートは前回から変化した場合のみ書き込む
+        self.sheet_views = SheetViewPublisher()
+        self.stats_cache = StatsCache(STATS_TTL)
+        # export_task と分析の両方からスレッドで呼ばれるため、同じ行を二重に追記しないよう書き出しは1つずつ行う
+        self.export_lock = Lock()
+
+    @property
+    def name(self):
+        return self.config.name
+
+    def get_worksheet(self, title):
+        return self.sheets.worksheet(title)
+
+    # --- 累計データの保存先 ---
+    def get_sheets_history_store(self):
+        codec = RowCodec(compact=SHEET_TIME_FORMAT == 'compact', tz=self.config.timezone)
+        return SheetsHistoryStore(self.get_worksheet("累計データ"), self.get_worksheet("メタデータ"), codec, budget=sheets_budget)
+
+    def open_history_store(self):
+        """HISTORY_BACKEND に応じた保存先を開く。SQLite が空の場合は既存のスプレッドシートから一度だけ取り込む"""
+        if HISTORY_BACKEND == 'sheets':
+            return self.get_sheets_history_store()
+        store = SqliteHistoryStore(self.config.db_path)
+        if store.is_empty():
+            print(f"[{self.name}] ローカルDBが空のため、スプレッドシートから累計データを取り込みます...")
+            sheet_view = self.get_sheets_history_store()
+            count = store.import_from(sheet_view)
+            self.state.sheet_view = sheet_view
+            print(f"[{self.name}] ✅ {count}件を取り込みました。")
+        return store
+
+    def export_history_to_sheet(self):
+        """SQLite に保存された変更を累計データシートへ反映する (シートは閲覧用のビュー)"""
+        state = self.state
+        if not isinstance(state.store, SqliteHistoryStore): return
+        with self.export_lock, run_metrics.span('export') as span:
+            if state.sheet_view is None:
+                state.sheet_view = self.get_sheets_history_store()
+            try:
+                count = state.store.export_to(state.sheet_view)
+            except Exception as e:
+                # シートが削除・作り直しされた場合、ビューは古いワークシートを指したままになるため次回作り直し、全件を書き出す
+                if is_stale_sheet_error(e):
+                    state.sheet_view = None
+                    state.store.mark_unexported()
+                raise
+            span.add('rows', count)
+        if count: print(f"[{self.name}] 累計データシートへ{count}件を反映しました")
+
+    async def sync(self, channel):
+        """未読み込みなら累計データを読み込み、取り込み位置以降のメッセージを追いかけて取り込む (呼び出し側で lock を取ること)"""
+        state = self.state
+        disconnects = state.disconnects
+        if not state.loaded:
+            with run_metrics.span('load') as span:
+                if state.store is None:
+                    state.store = await sheets_publisher.run(self.open_history_store)
+                records, watermark = await sheets_publisher.run(state.store.load)
+                span.add('rows', len(records))
+            with run_metrics.span('aggregate', rows=len(records)):
+                state.aggregator = await sheets_publisher.run(MonthlyAggregator.from_records, records)
+            state.records, state.watermark = records, watermark
+            state.version += 1
+
+        # 取り込み位置はメッセージ1件ごとに進むため、一時的なエラーで取得が途切れても続きから取り直せる
+        attempt = 0
+        while True:
+            # 前回の取り込み位置以降のメッセージのみ取得する (初回のみ MESSAGE_LIMIT 件遡ってバックフィル)
+            last_id = state.watermark['last_message_id']
+            newest = None
+            if last_id:
+                history = channel.history(limit=None, after=discord.Object(id=last_id), oldest_first=True)
+                on_message_seen = state.advance_watermark
+            else:
+                print(f"[{self.name}] 取り込み位置が未保存のため、直近{MESSAGE_LIMIT}件をバックフィルします...")
+                history = channel.history(limit=MESSAGE_LIMIT, oldest_first=False)
+                # バックフィルは新しい順に届くため、最初の1件で取り込み位置を進めると、途中で失敗したときに
+                # それより古い未処理のメッセージを二度と取得しなくなる。最後まで読めた場合のみ進める
+                def on_message_seen(message):
+                    nonlocal newest
+                    if newest is None or message.id > newest.id: newest = message
+
+            stats = {}
+            try:
+                count, changed = await run_pipeline(history, on_message_seen, state.fold, stats=stats, config=self.config, skip=is_bot_command)
+                if newest is not None: state.advance_watermark(newest)
+                break
+            except Exception as e:
+                # バックフィルは新しい順に取得するため、途中からは再開できない
+                if not last_id or not discord_backoff.should_retry(attempt, e): raise
+                print(f"[{self.name}] 履歴の取得が中断されました ({e})。続きから取り直します...")
+                await asyncio.sleep(discord_backoff.delay(attempt, e))
+                attempt += 1
+
+        # 取得と分類は1件ずつ交互に進むため、履歴の取得待ちを fetch、それ以外を classify として記録する (取り直した場合は最後の1回分)
+        run_metrics.observe('fetch', stats['wait_sec'], messages=count, discord_retries=attempt)
+        run_metrics.observe('classify', stats['total_sec'] - stats['wait_sec'], observations=stats['observations'], changed=changed)
+        if count: print(f"[{self.name}] 未取り込みメッセージ: {count}件 (更新: {changed}件)")
+        state.caught_up = state.disconnects == disconnects
+
+    async def flush(self, force=False):
+        """バッファされた変更を保存先へ書き出す"""
+        state = self.state
+        async with state.flush_lock:
+            if not state.loaded: return
+            if not state.pending and not (force and state.watermark_dirty): return
+
+            if state.store is None:
+                state.store = await sheets_publisher.run(self.open_history_store)
+            keys, snapshot, watermark = state.take_pending()
+            try:
+                with run_metrics.span('save', rows=len(keys)):
+                    count = await sheets_publisher.run(state.store.save, snapshot, keys, watermark)
+            except Exception as e:
+                state.restore_pending(keys)
+                # シートが削除・作り直しされた場合、保存先は古いワークシートを指したままになるため次回開き直し、
+                # 失われた行も書き直せるようメモリ上の全ての記録を未保存に戻す
+                if is_stale_sheet_error(e) and isinstance(state.store, SheetsHistoryStore):
+                    state.store = None
+                    state.pending |= set(state.records.rows())
+                raise
+            print(f"[{self.name}] 累計データを保存しました ({count}件の変更)")
+
+    # --- 分析メインロジック ---
+    async def perform_analysis(self):
+        print(f"[{self.name}] perform_analysis...")
+
+        target_channel = bot.get_channel(self.config.channel_id)
+        if not target_channel:
+            return None, None, [], [], "Channel not found."
+
+        # 通常は on_message で取り込み済みのため、ここでは取りこぼし分の追いかけと保存のみ行う
+        state = self.state
+        async with state.lock:
+            await self.sync(target_channel)
+        await self.flush(force=True)
+        await sheets_publisher.run(self.export_history_to_sheet)
+        records = state.records
+        aggregator = state.aggregator
+        user_id_map = state.watermark['user_ids']
+
+        with run_metrics.span('aggregate', users=len(aggregator.users())):
+            analysis_data, missing_users, daily_summary_texts = summarize(records, aggregator, user_id_map, self.config)
+        return analysis_data, aggregator, missing_users, daily_summary_texts, None
+
+    async def publish_sheets(self, analysis_data, aggregator):
+        """ランキングと月別平均推移のシートを並行して更新する"""
+        monthly_headers, monthly_rows = render_monthly_average_rows(aggregator)
+        await asyncio.gather(
+            write_sheet('ranking_write', len(analysis_data),
+                        lambda: update_spreadsheet(self.get_worksheet("起床時刻ランキング"), analysis_data, self.sheet_views, self.config.timezone)),
+            write_sheet('monthly_write', len(monthly_rows),
+                        lambda: update_monthly_average_sheet(self.get_worksheet("月別平均推移"), monthly_headers, monthly_rows, self.sheet_views)),
+        )
+
+    async def post_daily_summary(self, missing_users, daily_summary_texts):
+        channel = bot.get_channel(self.config.channel_id)
+        if not channel: return
+        msg_lines = ["📊 **本日の記録サマリー**"]
+
+        if daily_summary_texts:
+            msg_lines.extend(daily_summary_texts)
         else:
-            timestamp_jst = message.created_at.astimezone(JST)
-
-        user_name = message.author.global_name or message.author.username
-        user_id_map[user_name] = message.author.id
-        
-        # 朝4時を1日の境目として日付を決定
-        logical_date_dt = timestamp_jst - datetime.timedelta(hours=4)
-        date_str = logical_date_dt.strftime("%Y-%m-%d")
-        
-        hour = timestamp_jst.hour
-        is_wake = 4 <= hour < 18
-        record_key = 'wake' if is_wake else 'sleep'
-        dt_to_record = timestamp_jst
-        
-        # 手動指定時刻の抽出 (起床のみ)
-        if is_wake:
-            ex_h, ex_m = extract_time_from_text(message.content)
-            if ex_h is not None and ex_m is not None:
-                if 4 <= ex_h < 18:
-                    dt_to_record = dt_to_record.replace(hour=ex_h, minute=ex_m, second=0, microsecond=0)
-        
-        existing_dt = user_daily_data[user_name].get(date_str, {}).get(record_key)
-        if existing_dt is None or dt_to_record < existing_dt:
-            user_daily_data[user_name][date_str][record_key] = dt_to_record
-
-    save_historical_data(db_sheet, user_daily_data)
-
-    now_jst = datetime.datetime.now(JST)
-    current_month, current_year = now_jst.month, now_jst.year
-    prev_month, prev_year = (12, current_year - 1) if current_month == 1 else (current_month - 1, current_year)
-
-    analysis_data = []
-    for user_name, daily_posts in user_daily_data.items():
-        all_wakes = []
-        cur_wakes, prev_wakes = [], []
-        cur_sleeps, prev_sleeps = [], []
-        
-        for dt_dict in daily_posts.values():
-            if 'wake' in dt_dict:
-                w_dt = dt_dict['wake']
-                sec = time_to_seconds(w_dt)
-                all_wakes.append(sec)
-                if w_dt.year == current_year and w_dt.month == current_month: cur_wakes.append(sec)
-                if w_dt.year == prev_year and w_dt.month == prev_month: prev_wakes.append(sec)
-            
-            if 'sleep' in dt_dict:
-                s_dt = dt_dict['sleep']
-                s_sec = time_to_seconds(s_dt, is_sleep=True)
-                s_logical = s_dt - datetime.timedelta(hours=4)
-                if s_logical.year == current_year and s_logical.month == current_month: cur_sleeps.append(s_sec)
-                if s_logical.year == prev_year and s_logical.month == prev_month: prev_sleeps.append(s_sec)
-
-        cur_w_avg = sum(cur_wakes) / len(cur_wakes) if cur_wakes else None
-        prev_w_avg = sum(prev_wakes) / len(prev_wakes) if prev_wakes else None
-        
-        analysis_data.append({
-            'userName': user_name, 
-            'overall_wake_avg': sum(all_wakes) / len(all_wakes) if all_wakes else None, 
-            'overall_count': len(all_wakes),
-            'current_wake_avg': cur_w_avg, 
-            'previous_wake_avg': prev_w_avg, 
-            'current_sleep_avg': sum(cur_sleeps) / len(cur_sleeps) if cur_sleeps else None,
-            'previous_sleep_avg': sum(prev_sleeps) / len(prev_sleeps) if prev_sleeps else None,
-            'delta_sec': cur_w_avg - prev_w_avg if (cur_w_avg is not None and prev_w_avg is not None) else None
-        })
-
-    analysis_data.sort(key=lambda x: x['current_wake_avg'] if x['current_wake_avg'] is not None else float('inf'))
+            msg_lines.append("本日の記録はまだありません。")
+
+        if missing_users:
+            msg_lines.append("") # 空行
+            msg_lines.append("🌅 おはようございます！ 以下のユーザーは本日の起床記録をお願いします！")
+            msg_lines.append(" ".join(missing_users))
+
+        text = "\n".join(msg_lines)
+        with run_metrics.span('summary_post', lines=len(msg_lines), mentions=len(missing_users), bytes=len(text.encode())):
+            await channel.send(text)
+
+    # ▼ 成績の照会 (メモリ上の集計から作り、API は呼ばない)
+    def current_stats(self):
+        """成績表を返す。古ければ作り直す (イベントループ上で呼ぶこと)。累計データが未読み込みなら None"""
+        state = self.state
+        if not state.loaded: return None
+        return self.stats_cache.get(state.version, lambda: build_stats(state.records, state.aggregator, self.config.now(), self.config.day_start_hour))
+
+    def current_stats_threadsafe(self):
+        """Flask のスレッドから成績表を取得する。キャッシュが新しければループを介さずに返す"""
+        if not self.state.loaded: return None
+        stats = self.stats_cache.peek(self.state.version)
+        if stats is not None: return stats
+
+        async def build():
+            return self.current_stats()
+        return asyncio.run_coroutine_threadsafe(build(), bot.loop).result(timeout=10)
+
+def summarize(records, aggregator, user_id_map, config):
+    """ランキングと今日の記録サマリー・未投稿者を作る"""
+    today_str, yesterday_str, current_ym, prev_ym = analysis_period(config.now(), config.day_start_hour)
+
+    analysis_data = build_ranking(aggregator, current_ym, prev_ym)
     
     # === 今日の記録サマリーと未投稿者の抽出 ===
-    today_dt = now_jst - datetime.timedelta(hours=4)
-    today_str = today_dt.strftime("%Y-%m-%d")
-    yesterday_str = (today_dt - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-    
-    active_users = {u for u, d in user_daily_data.items() if any(k.startswith(f"{current_year}-{current_month:02d}") for k in d.keys())}
+    active_users = {u for u in aggregator.users() if aggregator.has_records(u, current_ym)}
     
     missing_users = []
     daily_report_list = []
     
     for user in active_users:
-        today_wake = user_daily_data[user].get(today_str, {}).get('wake')
-        yesterday_sleep = user_daily_data[user].get(yesterday_str, {}).get('sleep')
+        today_wake = records.get_seconds(user, today_str, 'wake')
+        yesterday_sleep = records.get_seconds(user, yesterday_str, 'sleep')
         
         if today_wake is None:
             if user in user_id_map:
                 missing_users.append(f"<@{user_id_map[user]}>")
         else:
-            wake_str = today_wake.strftime("%H:%M")
-            sleep_str = yesterday_sleep.strftime("%H:%M") if yesterday_sleep else "--:--"
+            wake_str = seconds_to_time_str(today_wake)
+            sleep_str = seconds_to_time_str(yesterday_sleep, is_sleep=True)
             
             daily_report_list.append({
                 'user': user,
@@ -270,100 +381,33 @@ async def perform_analysis():
             
     daily_report_list.sort(key=lambda x: x['wake_time'])
     daily_summary_texts = [item['text'] for item in daily_report_list]
-
-    return analysis_data, user_daily_data, missing_users, daily_summary_texts, None
+    return analysis_data, missing_users, daily_summary_texts
 
 
-# --- スプレッドシート更新ロジック ---
-def update_spreadsheet(analysis_data):
+async def write_sheet(phase, rows, fn):
+    """シートの更新1つを計測区間で囲んで実行する。失敗しても他のシートの更新は続ける"""
     try:
-        spreadsheet = get_spreadsheet()
-        sheet = get_or_create_worksheet(spreadsheet, "起床時刻ランキング")
-        if not analysis_data: return
-        sheet.clear()
-        
-        now_jst = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9)))
-        sheet.update('A1', [[f"起床時刻ランキング (最終更新: {now_jst.strftime('%Y/%m/%d %H:%M')})"]])
-        
-        headers = ['順位', 'ユーザー名', '今月の起床', '今月の就寝', '先月の起床', '先月の就寝', '変化(起床)', '累計起床', '累計日数']
-        sheet.update('A2', [headers])
-        
-        rows = []
-        for index, user in enumerate(analysis_data):
-            rows.append([
-                index + 1,
-                user['userName'],
-                seconds_to_time_str(user['current_wake_avg']),
-                seconds_to_time_str(user['current_sleep_avg'], is_sleep=True),
-                seconds_to_time_str(user['previous_wake_avg']),
-                seconds_to_time_str(user['previous_sleep_avg'], is_sleep=True),
-                format_delta_seconds(user['delta_sec']),
-                seconds_to_time_str(user['overall_wake_avg']),
-                user['overall_count']
-            ])
-
-        if rows: sheet.update('A3', rows)
-
-        requests = [
-            { "updateSheetProperties": { "properties": { "sheetId": sheet.id, "gridProperties": { "frozenRowCount": 2 } }, "fields": "gridProperties.frozenRowCount" } },
-            { "mergeCells": { "range": { "sheetId": sheet.id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": 9 }, "mergeType": "MERGE_ALL" } },
-            { "repeatCell": { "range": { "sheetId": sheet.id, "startRowIndex": 0, "endRowIndex": 1 }, "cell": { "userEnteredFormat": { "textFormat": { "bold": True, "fontSize": 12 }, "horizontalAlignment": "CENTER", "verticalAlignment": "MIDDLE" } }, "fields": "userEnteredFormat(textFormat,horizontalAlignment,verticalAlignment)" } },
-            { "repeatCell": { "range": { "sheetId": sheet.id, "startRowIndex": 1, "endRowIndex": 2 }, "cell": { "userEnteredFormat": { "backgroundColor": { "red": 0.2, "green": 0.2, "blue": 0.2 }, "textFormat": { "foregroundColor": { "red": 1, "green": 1, "blue": 1 }, "bold": True }, "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)" } },
-            { "repeatCell": { "range": { "sheetId": sheet.id, "startRowIndex": 2 }, "cell": { "userEnteredFormat": { "verticalAlignment": "MIDDLE" } }, "fields": "userEnteredFormat.verticalAlignment" } },
-            { "repeatCell": { "range": { "sheetId": sheet.id, "startRowIndex": 2, "startColumnIndex": 0, "endColumnIndex": 1 }, "cell": { "userEnteredFormat": { "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat.horizontalAlignment" } },
-            { "repeatCell": { "range": { "sheetId": sheet.id, "startRowIndex": 2, "startColumnIndex": 2, "endColumnIndex": 9 }, "cell": { "userEnteredFormat": { "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat.horizontalAlignment" } },
-            { "updateDimensionProperties": { "range": { "sheetId": sheet.id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": 1 }, "properties": { "pixelSize": 40 }, "fields": "pixelSize" } },
-            { "updateDimensionProperties": { "range": { "sheetId": sheet.id, "dimension": "COLUMNS", "startIndex": 1, "endIndex": 2 }, "properties": { "pixelSize": 120 }, "fields": "pixelSize" } },
-            { "updateDimensionProperties": { "range": { "sheetId": sheet.id, "dimension": "COLUMNS", "startIndex": 2, "endIndex": 9 }, "properties": { "pixelSize": 75 }, "fields": "pixelSize" } },
-        ]
-        sheet.spreadsheet.batch_update({"requests": requests})
+        with run_metrics.span(phase, rows=rows) as span:
+            written = await sheets_publisher.run(fn)
+            # 前回と同じ内容のため書き込みを省いた回数
+            if not written: span.add('skipped')
     except Exception as e:
         print(f"error: {e}")
 
-def update_monthly_average_sheet(user_daily_data):
-    try:
-        spreadsheet = get_spreadsheet()
-        sheet = get_or_create_worksheet(spreadsheet, "月別平均推移")
-        if not user_daily_data: return
-        sheet.clear()
-
-        all_year_months = sorted(list({k[:7].replace('-','/') for daily in user_daily_data.values() for k in daily.keys()}))
-        if not all_year_months: return
-
-        headers = ['ユーザー名']
-        for ym in all_year_months:
-            headers.append(f"{ym} 起床")
-            # 2026年5月以降のみ就寝列を追加
-            if ym >= "2026/05":
-                headers.append(f"{ym} 就寝")
-        
-        rows = []
-        for user in sorted(user_daily_data.keys()):
-            row = [user]
-            for ym in all_year_months:
-                w_secs, s_secs = [], []
-                for d_str, times in user_daily_data[user].items():
-                    if d_str.startswith(ym.replace('/','-')):
-                        if 'wake' in times: w_secs.append(time_to_seconds(times['wake']))
-                        if 'sleep' in times: s_secs.append(time_to_seconds(times['sleep'], is_sleep=True))
-                
-                row.append(seconds_to_time_str(sum(w_secs)/len(w_secs)) if w_secs else "--:--")
-                
-                if ym >= "2026/05":
-                    row.append(seconds_to_time_str(sum(s_secs)/len(s_secs), is_sleep=True) if s_secs else "--:--")
-            rows.append(row)
-
-        sheet.update('A1', [headers])
-        if rows: sheet.update('A2', rows)
-        
-        requests = [
-            { "updateSheetProperties": { "properties": { "sheetId": sheet.id, "gridProperties": { "frozenRowCount": 1, "frozenColumnCount": 1 } }, "fields": "gridProperties.frozenRowCount,gridProperties.frozenColumnCount" } },
-            { "repeatCell": { "range": { "sheetId": sheet.id, "startRowIndex": 0, "endRowIndex": 1 }, "cell": { "userEnteredFormat": { "backgroundColor": { "red": 0.2, "green": 0.2, "blue": 0.2 }, "textFormat": { "foregroundColor": { "red": 1, "green": 1, "blue": 1 }, "bold": True }, "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)" } },
-            { "repeatCell": { "range": { "sheetId": sheet.id, "startRowIndex": 1, "startColumnIndex": 1 }, "cell": { "userEnteredFormat": { "horizontalAlignment": "CENTER" } }, "fields": "userEnteredFormat.horizontalAlignment" } },
-        ]
-        sheet.spreadsheet.batch_update({"requests": requests})
-    except Exception as e:
-        print(f"error: {e}")
+# チャンネルID -> ChannelTracker
+trackers = {config.channel_id: ChannelTracker(config) for config in CHANNELS.values()}
+
+async def for_each_tracker(fn):
+    """全チャンネルに fn(tracker) を並行して適用する (同時に最大 ANALYSIS_WORKERS 個)。失敗はチャンネルごとに記録して続ける"""
+    semaphore = asyncio.Semaphore(ANALYSIS_WORKERS)
+
+    async def run(tracker):
+        async with semaphore:
+            try:
+                await fn(tracker)
+            except Exception as e:
+                print(f"[{tracker.name}] error: {e}")
+    await asyncio.gather(*(run(tracker) for tracker in trackers.values()))
 
 # --- Discord Bot メイン処理 ---
 intents = discord.Intents.default()
@@ -371,39 +415,84 @@ intents.messages = True
 intents.message_content = True
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+def is_bot_command(message):
+    """!mystats のような Bot コマンドの投稿か (起床・就寝の記録には使わない)"""
+    if not message.content.startswith(bot.command_prefix): return False
+    words = message.content[len(bot.command_prefix):].split(maxsplit=1)
+    return bool(words) and words[0] in bot.all_commands
+
 @bot.event
 async def on_ready():
-    check_queue_task.start()
-
-# ▼ GASからのトリガーで走る処理（サマリーとメンションを送る）
-@tasks.loop(seconds=5)
-async def check_queue_task():
-    if not analysis_queue.empty():
-        analysis_queue.get()
-        try:
-            analysis_data, user_daily_data, missing_users, daily_summary_texts, error = await perform_analysis()
-            if error: return
-            update_spreadsheet(analysis_data)
-            update_monthly_average_sheet(user_daily_data)
-            
-            channel = bot.get_channel(TARGET_CHANNEL_ID)
-            if channel:
-                msg_lines = ["📊 **本日の記録サマリー**"]
-                
-                if daily_summary_texts:
-                    msg_lines.extend(daily_summary_texts)
-                else:
-                    msg_lines.append("本日の記録はまだありません。")
-                    
-                if missing_users:
-                    msg_lines.append("") # 空行
-                    msg_lines.append("🌅 おはようございます！ 以下のユーザーは本日の起床記録をお願いします！")
-                    msg_lines.append(" ".join(missing_users))
-                    
-                await channel.send("\n".join(msg_lines))
-                
-        except Exception as e:
-            print(f"error: {e}")
+    loop_lag_monitor.start()
+    analysis_scheduler.start()
+    if not flush_task.is_running():
+        flush_task.start()
+    if HISTORY_BACKEND != 'sheets' and not export_task.is_running():
+        export_task.start()
+    # 起動時に各チャンネルの累計データを読み込み、停止中の投稿を取り込んでおく
+    await for_each_tracker(catch_up)
+
+async def catch_up(tracker):
+    channel = bot.get_channel(tracker.config.channel_id)
+    if not channel: return
+    async with tracker.state.lock:
+        await tracker.sync(channel)
+
+# 切断中の投稿は on_message に届かないため、再接続したら追いかけ終えるまで取り込み位置を進めない
+@bot.event
+async def on_disconnect():
+    for tracker in trackers.values():
+        tracker.state.caught_up = False
+        tracker.state.disconnects += 1
+
+@bot.event
+async def on_resumed():
+    await for_each_tracker(catch_up)
+
+# ▼ 投稿をリアルタイムに取り込む (シートへの保存は flush_task でまとめて行う)
+@bot.listen('on_message')
+async def ingest_on_message(message):
+    tracker = trackers.get(message.channel.id)
+    if tracker is None or is_bot_command(message): return
+    state = tracker.state
+    try:
+        async with state.lock:
+            if not state.caught_up:
+                await tracker.sync(message.channel)
+            state.ingest(message)
+        if len(state.pending) >= FLUSH_BATCH_SIZE:
+            await tracker.flush()
+    except Exception as e:
+        print(f"error: {e}")
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_task():
+    await for_each_tracker(lambda tracker: tracker.flush())
+
+@tasks.loop(seconds=EXPORT_INTERVAL)
+async def export_task():
+    await for_each_tracker(lambda tracker: sheets_publisher.run(tracker.export_history_to_sheet))
+
+# ▼ 分析ジョブ (GASからのトリガーと !analyze の両方がここを通る。ジョブの key はチャンネルID)
+async def run_analysis_job(job):
+    tracker = trackers[job.key]
+    with loop_lag_monitor.watch() as lag, run_metrics.run(tracker.name):
+        analysis_data, aggregator, missing_users, daily_summary_texts, error = await tracker.perform_analysis()
+        if error: raise RuntimeError(error)
+        await tracker.publish_sheets(analysis_data, aggregator)
+
+        # サマリーとメンションは GAS からのトリガーを含むジョブのみ送る
+        if job.options.get('post_summary'):
+            await tracker.post_daily_summary(missing_users, daily_summary_texts)
+    print(f"Sheets API: {sheets_session.summary()}")
+    print(f"[{tracker.name}] フェーズ別所要時間: {run_metrics.summary(tracker.name)}")
+    retries = run_metrics.last_run_items('sheets_throttled', 'sheets_retries', 'sheets_resumes', 'discord_retries', channel=tracker.name)
+    print(f"[{tracker.name}] API の待機・再試行: Sheets 待機{retries['sheets_throttled']}回 / 再試行{retries['sheets_retries']}回 / やり直し{retries['sheets_resumes']}回, Discord 取り直し{retries['discord_retries']}回")
+    print(f"[{tracker.name}] イベントループの最大遅延: {lag['max_lag'] * 1000:.1f}ms")
+
+# 実行待ちの分析要求はチャンネルごとに1つにまとめられ、最大 ANALYSIS_WORKERS チャンネルを並行して分析する
+# (同じチャンネルの分析は同時に1つしか走らない)
+analysis_scheduler = JobScheduler(run_analysis_job, concurrency=ANALYSIS_WORKERS)
 
 def require_secret(f):
     @wraps(f)
@@ -413,32 +502,96 @@ def require_secret(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def requested_trackers():
+    """?channel= で指定されたチャンネル (省略時は全チャンネル)。不明なチャンネルなら None"""
+    channel = request.args.get('channel')
+    if channel is None: return list(trackers.values())
+    tracker = trackers.get(int(channel)) if channel.isdigit() else None
+    return [tracker] if tracker is not None else None
+
 @app.route('/trigger-analysis', methods=['POST'])
 @require_secret
 def handle_trigger_analysis():
-    analysis_queue.put(1)
-    return 'Analysis triggered.', 200
+    targets = requested_trackers()
+    if targets is None:
+        return jsonify({'error': 'Channel not found.'}), 404
+    jobs = [analysis_scheduler.submit_threadsafe('analysis', key=tracker.config.channel_id, post_summary=True) for tracker in targets]
+    body = {'message': 'Analysis triggered.', 'jobs': [{'channel_id': str(job.key), 'job_id': job.id, 'status': job.status} for job in jobs]}
+    # 1チャンネルのみの場合は従来どおり job_id / status も返す
+    if len(jobs) == 1: body.update(job_id=jobs[0].id, status=jobs[0].status)
+    return jsonify(body), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@require_secret
+def handle_job_status(job_id):
+    job = analysis_scheduler.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    return jsonify(job), 200
+
+def stats_response(user_name=None):
+    targets = requested_trackers()
+    if targets is None:
+        return jsonify({'error': 'Channel not found.'}), 404
+    if len(targets) != 1:
+        return jsonify({'error': 'Specify a channel with ?channel=<channel_id>.'}), 400
+    stats = targets[0].current_stats_threadsafe()
+    if stats is None:
+        return jsonify({'error': 'History is not loaded yet.'}), 503
+    if user_name is None:
+        return jsonify(stats), 200
+    entry = find_user(stats, user_name)
+    if entry is None:
+        return jsonify({'error': 'User not found.'}), 404
+    return jsonify(dict(entry, generated_at=stats['generated_at'], current_month=stats['current_month'], previous_month=stats['previous_month'])), 200
+
+@app.route('/stats', methods=['GET'])
+@require_secret
+def handle_stats():
+    return stats_response()
+
+@app.route('/stats/<user_name>', methods=['GET'])
+@require_secret
+def handle_user_stats(user_name):
+    return stats_response(user_name)
+
+# ▼ 計測値 (Prometheus のテキスト形式)
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    body = run_metrics.render(sheets_session.snapshot(), loop_lag_monitor)
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
 
 # ▼ 手動実行コマンド（サマリーとメンションは送らない）
 @bot.command()
 async def analyze(ctx):
-    if ctx.channel.id != TARGET_CHANNEL_ID: return
+    tracker = trackers.get(ctx.channel.id)
+    if tracker is None: return
     await ctx.send("分析を開始します。少しお待ちください...")
     try:
-        # 手動実行時は missing_users 等は使わず、単純に集計とシート更新のみ行う
-        analysis_data, user_daily_data, _, _, error = await perform_analysis()
-        if error:
-            await ctx.send(f"エラー: {error}")
-            return
-            
-        update_spreadsheet(analysis_data)
-        update_monthly_average_sheet(user_daily_data)
+        # 手動実行時は集計とシート更新のみ行う (このチャンネルの実行待ちのトリガーがあればそれにまとめられる)
+        job = analysis_scheduler.submit('analysis', key=tracker.config.channel_id)
+        await analysis_scheduler.wait(job)
         
-        sheet_url = f"https://docs.google.com/spreadsheets/d/{SHEET_ID}"
-        await ctx.send(f"分析とシートの更新が完了しました！\n結果はこちら: {sheet_url}")
+        await ctx.send(f"分析とシートの更新が完了しました！\n結果はこちら: {tracker.config.sheet_url}")
             
     except Exception as e:
         await ctx.send(f"エラーが発生しました: {e}")
 
+# ▼ 自分の成績 (キャッシュから返すため、シートの更新や履歴の取得は行わない)
+@bot.command()
+async def mystats(ctx):
+    tracker = trackers.get(ctx.channel.id)
+    if tracker is None: return
+    stats = tracker.current_stats()
+    if stats is None:
+        await ctx.send("累計データを読み込み中です。しばらくしてからもう一度お試しください。")
+        return
+    user_name = user_name_of(ctx.author)
+    entry = find_user(stats, user_name)
+    if entry is None:
+        await ctx.send(f"**{user_name}** さんの記録はまだありません。")
+        return
+    await ctx.send(format_user_stats(stats, entry))
+
 keep_alive()
 bot.run(BOT_TOKEN)
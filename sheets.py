@@ -0,0 +1,225 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import gspread
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+# --- Google Sheets セッション ---
+# 認証済みクライアント・HTTP接続・ワークシートのハンドルをプロセス全体で使い回し、
+# 実行のたびに発生していた OAuth とメタデータ取得の往復を無くす (複数チャンネルのスプレッドシートでも接続は1つ)
+
+def classify_endpoint(method, endpoint):
+    """Sheets API の URL を集計用の操作名 (values.get, batchUpdate など) に変換する"""
+    path = urlparse(endpoint).path
+    if '/spreadsheets/' not in path: return 'drive'
+    sheet_part, _, rest = path.split('/spreadsheets/', 1)[1].partition('/')
+    if not rest:
+        if ':' in sheet_part: return sheet_part.split(':', 1)[1]
+        return 'metadata'
+    if rest.startswith('values:'):
+        return 'values.' + rest.split(':', 1)[1]
+    if rest.startswith('values/'):
+        for action in ('append', 'clear'):
+            if rest.endswith(':' + action): return 'values.' + action
+        return 'values.get' if method.upper() == 'GET' else 'values.update'
+    return rest.split('/', 1)[0]
+
+def is_idempotent(method, endpoint, body=None):
+    """同じリクエストを2回送っても結果が変わらないか (追記とシートの追加は2回目で行やシートが増える/失敗する)"""
+    if classify_endpoint(method, endpoint) == 'values.append': return False
+    if body and any('addSheet' in req or 'duplicateSheet' in req for req in body.get('requests', [])): return False
+    return True
+
+class InstrumentedHTTPClient(HTTPClient):
+    """全ての API 呼び出しの所要時間とレスポンスを on_request に通知する HTTPClient
+
+    budget (RequestBudget) があれば、呼び出しの前に読み取り/書き込みの予算を取り、
+    冪等なリクエストは一時的なエラーで再試行する (再試行も1回の呼び出しとして on_request に通知される)。
+    """
+    on_request = None
+    budget = None
+
+    def request(self, method, endpoint, *args, **kwargs):
+        if self.budget is None:
+            return self._request(method, endpoint, *args, **kwargs)
+        kind = 'read' if method.upper() == 'GET' else 'write'
+        idempotent = is_idempotent(method, endpoint, kwargs.get('json'))
+        return self.budget.call(kind, lambda: self._request(method, endpoint, *args, **kwargs), idempotent)
+
+    def _request(self, method, endpoint, *args, **kwargs):
+        start = time.perf_counter()
+        error = None
+        response = None
+        try:
+            response = super().request(method, endpoint, *args, **kwargs)
+            return response
+        except APIError as e:
+            error = e
+            response = e.response
+            raise
+        finally:
+            if self.on_request:
+                self.on_request(method, endpoint, time.perf_counter() - start, error, response)
+
+# 削除されたシートを指している場合のエラー
+# (範囲の指定では 'Unable to parse range'、batchUpdate の sheetId の指定では 'No grid with id' が返る)
+STALE_SHEET_ERRORS = ('Unable to parse range', 'No grid with id')
+
+def is_stale_sheet_error(error):
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code == 400 and any(text in str(error) for text in STALE_SHEET_ERRORS)
+
+def spreadsheet_key(endpoint):
+    """Sheets API の URL からスプレッドシートのIDを取り出す (Drive API などは None)"""
+    path = urlparse(endpoint).path
+    if '/spreadsheets/' not in path: return None
+    return path.split('/spreadsheets/', 1)[1].partition('/')[0].split(':', 1)[0]
+
+class SpreadsheetHandle:
+    """スプレッドシート1つ分のハンドル (開いたスプレッドシートとワークシートのキャッシュ)
+
+    ロックはスプレッドシートごとに持つため、あるチャンネルのシートを開いている間も他のチャンネルの処理は止まらない。
+    """
+    def __init__(self, session, sheet_id):
+        self.session = session
+        self.sheet_id = sheet_id
+        self.lock = threading.RLock()
+        self._spreadsheet = None
+        self._worksheets = {}
+
+    def spreadsheet(self):
+        with self.lock:
+            if self._spreadsheet is None:
+                metrics = self.session.metrics
+                if metrics is None:
+                    self._spreadsheet = self.session.client().open_by_key(self.sheet_id)
+                else:
+                    with metrics.span('auth'):
+                        self._spreadsheet = self.session.client().open_by_key(self.sheet_id)
+            return self._spreadsheet
+
+    def worksheet(self, title):
+        """ワークシートのハンドルを返す。存在しなければ作成する"""
+        with self.lock:
+            worksheet = self._worksheets.get(title)
+            if worksheet is None:
+                spreadsheet = self.spreadsheet()
+                budget = self.session.budget
+                if budget is None:
+                    worksheet = self._find_or_add(spreadsheet, title)
+                else:
+                    # シートの追加は再送できないため、失敗したら存在を確かめるところからやり直す
+                    worksheet = budget.run_resumable(lambda: self._find_or_add(spreadsheet, title), lambda: None)
+                self._worksheets[title] = worksheet
+            return worksheet
+
+    def _find_or_add(self, spreadsheet, title):
+        try:
+            return spreadsheet.worksheet(title)
+        except gspread.WorksheetNotFound:
+            return spreadsheet.add_worksheet(title=title, rows="1000", cols="20")
+
+    def invalidate(self, title=None):
+        with self.lock:
+            if title is None:
+                self._worksheets.clear()
+            else:
+                self._worksheets.pop(title, None)
+
+class SheetsSession:
+    """スレッドセーフな Sheets セッション
+
+    認証済みクライアント (HTTP接続)・呼び出し予算・呼び出しの統計は全てのスプレッドシートで共有し、
+    スプレッドシートごとのハンドルは open() で取得する。Sheets API の割り当てはサービスアカウント単位のため、
+    チャンネルが増えても budget は1つで全体を均す。
+    アクセストークンの更新は gspread 内部の AuthorizedSession が期限切れ時に自動で行う。
+    シートが削除されるなどして範囲を解決できなくなった場合は、そのスプレッドシートのワークシートのハンドルを捨てて次回取り直す。
+    metrics (RunMetrics) を渡すと、認証とスプレッドシートを開く処理を auth フェーズとして計測し、
+    API 呼び出しの回数と送受信バイト数を実行中の区間に加える。
+    budget (RequestBudget) を渡すと、全ての API 呼び出しがその予算と再試行の下で行われる。
+    """
+    def __init__(self, credentials_loader, metrics=None, budget=None):
+        self.credentials_loader = credentials_loader
+        self.metrics = metrics
+        self.budget = budget
+        self.lock = threading.RLock()
+        self._client = None
+        self._handles = {}  # スプレッドシートID -> SpreadsheetHandle
+        self.stats = defaultdict(lambda: {'calls': 0, 'errors': 0, 'total_sec': 0.0, 'max_sec': 0.0, 'sent_bytes': 0, 'received_bytes': 0})
+
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                self._client = gspread.authorize(self.credentials_loader(), http_client=InstrumentedHTTPClient)
+                self._client.http_client.on_request = self._record
+                self._client.http_client.budget = self.budget
+            return self._client
+
+    def open(self, sheet_id):
+        """スプレッドシートのハンドルを返す (API は呼ばない)"""
+        with self.lock:
+            handle = self._handles.get(sheet_id)
+            if handle is None:
+                handle = self._handles[sheet_id] = SpreadsheetHandle(self, sheet_id)
+            return handle
+
+    def invalidate(self, sheet_id=None):
+        """sheet_id のワークシートのハンドルを捨てる (省略時は全てのスプレッドシート)"""
+        with self.lock:
+            handles = list(self._handles.values()) if sheet_id is None else [self._handles.get(sheet_id)]
+        for handle in handles:
+            if handle is not None: handle.invalidate()
+
+    def snapshot(self):
+        with self.lock:
+            return {kind: dict(stat) for kind, stat in self.stats.items()}
+
+    def summary(self):
+        return ", ".join(
+            f"{kind}: {stat['calls']}回 (平均{stat['total_sec'] / stat['calls'] * 1000:.0f}ms, エラー{stat['errors']})"
+            for kind, stat in sorted(self.snapshot().items()))
+
+    def _record(self, method, endpoint, elapsed, error, response=None):
+        kind = classify_endpoint(method, endpoint)
+        sent = received = 0
+        if response is not None:
+            body = response.request.body if response.request is not None else None
+            sent = len(body or b'')
+            received = len(response.content or b'')
+        with self.lock:
+            stat = self.stats[kind]
+            stat['calls'] += 1
+            stat['total_sec'] += elapsed
+            stat['max_sec'] = max(stat['max_sec'], elapsed)
+            stat['sent_bytes'] += sent
+            stat['received_bytes'] += received
+            if error is not None: stat['errors'] += 1
+        if self.metrics is not None:
+            self.metrics.add('sheets_calls')
+            self.metrics.add('sheets_sent_bytes', sent)
+            self.metrics.add('sheets_received_bytes', received)
+            if error is not None: self.metrics.add('sheets_errors')
+        # 削除されたシートを指すハンドルは使い回せないため破棄する
+        if error is not None and is_stale_sheet_error(error):
+            self.invalidate(spreadsheet_key(endpoint))
+
+
+class SheetsPublisher:
+    """同期的な gspread / SQLite の呼び出しを専用のスレッドプールで実行し、await できるようにする
+
+    呼び出し元の contextvars を引き継ぐため、スレッド内の API 呼び出しも呼び出し元の計測区間に数えられる。
+    """
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sheets')
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args, **kwargs))
@@ -0,0 +1,121 @@
+import datetime
+import threading
+import time
+
+from aggregation import build_ranking
+from timeutil import seconds_to_time_str
+
+# --- 成績の照会 ---
+# 取り込み済みのメモリ上の集計 (DailyRecords / MonthlyAggregator) から成績表を作り、
+# 取り込みで内容が変わるか ttl 秒経つまで使い回す。シートや Discord の API は呼ばない。
+
+def analysis_period(now, day_start_hour=4):
+    """(今日, 昨日, 今月, 先月) を返す。日付は day_start_hour 時区切りの論理日付 'YYYY-MM-DD'、月は 'YYYY-MM'
+
+    now はチャンネルのタイムゾーンの現在時刻。
+    """
+    current_month, current_year = now.month, now.year
+    prev_month, prev_year = (12, current_year - 1) if current_month == 1 else (current_month - 1, current_year)
+    today_dt = now - datetime.timedelta(hours=day_start_hour)
+    return (
+        today_dt.strftime("%Y-%m-%d"),
+        (today_dt - datetime.timedelta(days=1)).strftime("%Y-%m-%d"),
+        f"{current_year}-{current_month:02d}",
+        f"{prev_year}-{prev_month:02d}",
+    )
+
+def streaks(days, today):
+    """(現在の連続記録日数, 最長の連続記録日数)。今日の記録がまだ無くても、昨日まで続いていれば継続中とみなす"""
+    longest = run = 0
+    prev = None
+    for day in days:
+        run = run + 1 if prev is not None and day == prev + 1 else 1
+        longest = max(longest, run)
+        prev = day
+    current = run if prev is not None and prev >= today - 1 else 0
+    return current, longest
+
+def time_or_none(seconds, is_sleep=False):
+    return None if seconds is None else seconds_to_time_str(seconds, is_sleep=is_sleep)
+
+def build_stats(records, aggregator, now, day_start_hour=4):
+    """全ユーザーの成績表 (ランキング順) を作る (共有中のデータを読むためイベントループ上で呼ぶこと)"""
+    today_str, yesterday_str, current_ym, prev_ym = analysis_period(now, day_start_hour)
+    today = datetime.date.fromisoformat(today_str).toordinal()
+    wake_days = records.recorded_days('wake')
+
+    users = []
+    for rank, entry in enumerate(build_ranking(aggregator, current_ym, prev_ym), start=1):
+        user_name = entry['userName']
+        current_streak, longest_streak = streaks(wake_days.get(user_name, []), today)
+        users.append({
+            'rank': rank,
+            'userName': user_name,
+            'overall_wake_avg': time_or_none(entry['overall_wake_avg']),
+            'overall_sleep_avg': time_or_none(aggregator.mean(user_name, 'sleep'), is_sleep=True),
+            'overall_count': entry['overall_count'],
+            'current_wake_avg': time_or_none(entry['current_wake_avg']),
+            'current_sleep_avg': time_or_none(entry['current_sleep_avg'], is_sleep=True),
+            'current_count': aggregator.count(user_name, 'wake', current_ym),
+            'previous_wake_avg': time_or_none(entry['previous_wake_avg']),
+            'previous_sleep_avg': time_or_none(entry['previous_sleep_avg'], is_sleep=True),
+            'delta_minutes': round(entry['delta_sec'] / 60) if entry['delta_sec'] is not None else None,
+            'current_streak': current_streak,
+            'longest_streak': longest_streak,
+            'today': {
+                'wake': time_or_none(records.get_seconds(user_name, today_str, 'wake')),
+                'sleep': time_or_none(records.get_seconds(user_name, yesterday_str, 'sleep'), is_sleep=True),
+            },
+        })
+
+    return {
+        'generated_at': now.isoformat(timespec='seconds'),
+        'today': today_str,
+        'current_month': current_ym,
+        'previous_month': prev_ym,
+        'users': users,
+    }
+
+def find_user(stats, user_name):
+    return next((entry for entry in stats['users'] if entry['userName'] == user_name), None)
+
+def format_user_stats(stats, entry):
+    """!mystats の返信文"""
+    delta = entry['delta_minutes']
+    delta_str = f"{'+' if delta >= 0 else '-'}{abs(delta)}分" if delta is not None else "N/A"
+    return "\n".join([
+        f"📈 **{entry['userName']}** の成績 (今月の順位: {entry['rank']}位 / {len(stats['users'])}人)",
+        f"🌅 起床: 今月 {entry['current_wake_avg'] or '--:--'} ｜ 先月 {entry['previous_wake_avg'] or '--:--'} ｜ 変化 {delta_str} ｜ 累計 {entry['overall_wake_avg'] or '--:--'} ({entry['overall_count']}日)",
+        f"🌙 就寝: 今月 {entry['current_sleep_avg'] or '--:--'} ｜ 先月 {entry['previous_sleep_avg'] or '--:--'} ｜ 累計 {entry['overall_sleep_avg'] or '--:--'}",
+        f"🔥 連続記録: {entry['current_streak']}日 (最長 {entry['longest_streak']}日)",
+        f"📅 今日: 🌅 {entry['today']['wake'] or '--:--'} ｜ 🌙 {entry['today']['sleep'] or '--:--'}",
+    ])
+
+class StatsCache:
+    """成績表のキャッシュ
+
+    取り込みのたびに増える版数 (IngestState.version) が変わるか、作ってから ttl 秒経つと作り直す。
+    ttl は日付・月の切り替わりを反映するためのもの。保持する成績表は作り直すまで変更しないため、別スレッドからそのまま読める。
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.version = None
+        self.built_at = 0.0
+        self.stats = None
+
+    def peek(self, version):
+        """新しい成績表があれば返す (無ければ None)"""
+        with self.lock:
+            if self.stats is not None and self.version == version and time.monotonic() - self.built_at < self.ttl:
+                return self.stats
+            return None
+
+    def get(self, version, build):
+        """新しい成績表を返す。古ければ build() で作り直す"""
+        stats = self.peek(version)
+        if stats is not None: return stats
+        stats = build()
+        with self.lock:
+            self.version, self.built_at, self.stats = version, time.monotonic(), stats
+        return stats
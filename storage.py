@@ -0,0 +1,273 @@
+import json
+import re
+import sqlite3
+import threading
+
+from codec import RowCodec
+from records import DailyRecords
+
+# --- 累計データの保存先 (ストレージバックエンド) ---
+# いずれのバックエンドも以下の2つのメソッドを持つ
+#   load() -> (records, watermark)  records は DailyRecords
+#   save(records, keys, watermark)  keys で指定された (ユーザー名, 日付) のみを書き込み、書き込んだ件数を返す
+HEADERS = ['ユーザー名', '日付', '起床時刻', '就寝時刻']
+
+def new_watermark():
+    return {'last_message_id': None, 'last_message_at': None, 'user_ids': {}}
+
+def decode_rows_into(records, codec, rows, first_row_number=1):
+    """(ユーザー名, 日付, 起床, 就寝) の行をまとめて DailyRecords に読み込む
+
+    読めない行 (日付が不正など) は飛ばす。読み込んだ行の {(ユーザー名, 日付): 行番号} を返す (行番号は first_row_number から数える)。
+    """
+    row_numbers = {}
+    for row_number, row in enumerate(rows, start=first_row_number):
+        try:
+            user_name, date_str, wake_sec, sleep_sec = codec.decode_row(row)
+            if not user_name or not date_str: continue
+            if wake_sec is not None: records.set_seconds(user_name, date_str, 'wake', wake_sec)
+            if sleep_sec is not None: records.set_seconds(user_name, date_str, 'sleep', sleep_sec)
+        except Exception:
+            continue
+        row_numbers[(user_name, date_str)] = row_number
+    return row_numbers
+
+
+class SheetsHistoryStore:
+    """累計データ・メタデータシートをそのまま保存先として使うバックエンド
+
+    累計データシートの (ユーザー名, 日付) → 行番号 の索引を保持し、変更のあった行だけを書き込む。
+    SQLite バックエンド使用時はエクスポート先 (閲覧用のビュー) として使われる。
+    budget (RequestBudget) を渡すと、書き込みが途中で失敗した場合に索引を読み直して続きから書き込む。
+    """
+    def __init__(self, worksheet, meta_worksheet, codec=None, budget=None):
+        self.worksheet = worksheet
+        self.meta_worksheet = meta_worksheet
+        self.codec = codec or RowCodec()
+        self.budget = budget
+        self.row_index = {}
+        self.indexed = False
+
+    def load(self):
+        return self.load_records(), self.load_watermark()
+
+    def load_records(self):
+        # 読み込みの失敗は空のシートとみなさず、そのまま呼び出し元へ伝える
+        all_values = self.worksheet.get_all_values()
+        header_row = all_values[0] if all_values else []
+
+        if not any(cell for row in all_values for cell in row):
+            # 本当に空のシートにのみヘッダーを書き込む
+            self.worksheet.append_row(HEADERS)
+            all_values = [HEADERS]
+        elif header_row[:1] != ['ユーザー名']:
+            raise ValueError("累計データシートの1行目がヘッダーではありません。")
+        elif len(header_row) == 3 and header_row[2] == 'タイムスタンプ':
+            # 旧形式は就寝時刻列が無いだけなので、ヘッダーの書き換えのみで移行できる (シートを空にしない)
+            print("⚠️ 旧形式のデータを検出。起床時刻へのマイグレーションを実行します...")
+            self.worksheet.update('A1', [HEADERS])
+            print("✅ マイグレーション完了。")
+
+        records = DailyRecords()
+        self.row_index = decode_rows_into(records, self.codec, all_values[1:], first_row_number=2)
+        self.indexed = True
+        return records
+
+    def load_row_index(self):
+        """行番号の索引だけを作り直す (ユーザー名・日付の2列のみ読む)"""
+        # 読み込みに失敗した場合は、古い索引のまま追記しないよう未作成の扱いに戻す
+        self.indexed = False
+        values = self.worksheet.get('A1:B')
+        if not any(cell for row in values for cell in row):
+            # 作り直されたばかりの空のシートには、追記の前にヘッダーを書き込む
+            self.worksheet.append_row(HEADERS)
+        row_index = {}
+        for row_number, row in enumerate(values[1:], start=2):
+            if len(row) >= 2 and row[0] and row[1]:
+                row_index[(row[0], row[1])] = row_number
+        self.row_index = row_index
+        self.indexed = True
+
+    # 最後に取り込んだメッセージIDを保存し、次回以降はそれより新しいメッセージのみを取得する
+    def load_watermark(self):
+        watermark = new_watermark()
+        # 読み込みの失敗は空のシートとみなさない (初期化すると保存済みの取り込み位置とユーザーIDが消えるため)
+        values = self.meta_worksheet.get_all_values()
+
+        if not values or values[0][:2] != ['キー', '値']:
+            self.meta_worksheet.clear()
+            self.meta_worksheet.update('A1', [['キー', '値']])
+            return watermark
+
+        for row in values[1:]:
+            if len(row) < 2 or not row[1]: continue
+            key, value = row[0], row[1]
+            try:
+                if key == 'last_message_id': watermark['last_message_id'] = int(value)
+                elif key == 'last_message_at': watermark['last_message_at'] = value
+                elif key == 'user_ids': watermark['user_ids'] = {k: int(v) for k, v in json.loads(value).items()}
+            except (ValueError, TypeError):
+                continue
+        return watermark
+
+    def save(self, records, keys, watermark):
+        updated, appended = self.save_records(records, keys)
+        # 累計データの保存に成功した後でのみ取り込み位置を進める
+        self.save_watermark(watermark)
+        return updated + appended
+
+    def save_records(self, records, keys):
+        """既存行はまとめて上書きし、新しい日は末尾に追記する
+
+        追記は再送すると行が重複するため、失敗した場合は索引を読み直し、既に追記された行は上書きとしてやり直す。
+        """
+        if self.budget is None:
+            return self._write_records(records, keys)
+        return self.budget.run_resumable(lambda: self._write_records(records, keys), self.load_row_index)
+
+    def _write_records(self, records, keys):
+        if not self.indexed: self.load_row_index()
+        updates, appends = [], []
+        for user_name, date_str in sorted(keys):
+            row = self.codec.encode_row(records, user_name, date_str)
+            row_number = self.row_index.get((user_name, date_str))
+            if row_number:
+                updates.append({'range': f"'{self.worksheet.title}'!A{row_number}:D{row_number}", 'values': [row]})
+            else:
+                appends.append(row)
+
+        if updates:
+            self.worksheet.spreadsheet.values_batch_update({'valueInputOption': 'RAW', 'data': updates})
+        if appends:
+            response = self.worksheet.append_rows(appends, value_input_option='RAW', table_range='A1')
+            # 追記された範囲 (例: '累計データ'!A120:D125) から行番号を割り当てる
+            match = re.search(r'![A-Z]+(\d+)', response['updates']['updatedRange'])
+            first_row = int(match.group(1))
+            for offset, row in enumerate(appends):
+                self.row_index[(row[0], row[1])] = first_row + offset
+        return len(updates), len(appends)
+
+    def save_watermark(self, watermark):
+        rows = [
+            ['キー', '値'],
+            ['last_message_id', str(watermark['last_message_id'] or '')],
+            ['last_message_at', watermark['last_message_at'] or ''],
+            ['user_ids', json.dumps({k: str(v) for k, v in watermark['user_ids'].items()}, ensure_ascii=False)],
+        ]
+        self.meta_worksheet.update('A1', rows)
+
+
+class SqliteHistoryStore:
+    """ローカルの SQLite ファイルを正とするバックエンド
+
+    時刻はコンパクト形式 ("HH:MM:SS") で保存する (旧来の isoformat の行もそのまま読める)。
+    各行は変更のたびに version が増え、シートへ書き出した時点の version を exported_version に記録する。
+    export_to() が未反映の行だけをスプレッドシートへ送る。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS daily_records (
+            user_name TEXT NOT NULL,
+            logical_date TEXT NOT NULL,
+            wake TEXT,
+            sleep TEXT,
+            version INTEGER NOT NULL DEFAULT 1,
+            exported_version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_name, logical_date)
+        );
+        CREATE INDEX IF NOT EXISTS idx_daily_records_unexported ON daily_records (exported_version, version);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # 取り込みとエクスポートが別スレッドから呼ばれても良いよう、接続は共有しロックで直列化する
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        self.codec = RowCodec(compact=True)
+
+    def is_empty(self):
+        with self.lock:
+            has_rows = self.conn.execute("SELECT 1 FROM daily_records LIMIT 1").fetchone()
+            has_meta = self.conn.execute("SELECT 1 FROM meta LIMIT 1").fetchone()
+        return not has_rows and not has_meta
+
+    def load(self):
+        records = DailyRecords()
+        with self.lock:
+            rows = self.conn.execute("SELECT user_name, logical_date, wake, sleep FROM daily_records").fetchall()
+            meta = dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+
+        decode_rows_into(records, self.codec, rows)
+        return records, self._watermark_from_meta(meta)
+
+    def save(self, records, keys, watermark):
+        rows = [self.codec.encode_row(records, u, d) for u, d in sorted(keys)]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO daily_records (user_name, logical_date, wake, sleep) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (user_name, logical_date) DO UPDATE SET
+                       wake = excluded.wake, sleep = excluded.sleep, version = daily_records.version + 1""",
+                rows)
+            self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", self._meta_from_watermark(watermark))
+        return len(rows)
+
+    def import_from(self, source):
+        """既存のスプレッドシート (旧3列形式を含む) から一括で取り込む。取り込んだ行はシートに反映済みとして扱う
+
+        読み込みに失敗した場合は何も書き込まずに例外を送出する (DB は空のままなので、次回の起動でまた取り込みを試みる)。
+        シートが空で取り込む物が無い場合も何も書き込まない。
+        """
+        records, watermark = source.load()
+        rows = [self.codec.encode_row(records, u, d) for u, d in records.rows()]
+        if not rows and watermark == new_watermark(): return 0
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT OR REPLACE INTO daily_records (user_name, logical_date, wake, sleep, version, exported_version)
+                   VALUES (?, ?, ?, ?, 1, 1)""",
+                rows)
+            self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", self._meta_from_watermark(watermark))
+        return len(rows)
+
+    def export_to(self, target):
+        """シートに未反映の行を target (SheetsHistoryStore) へ書き出す。書き出した件数を返す"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT user_name, logical_date, wake, sleep, version FROM daily_records WHERE version > exported_version"
+            ).fetchall()
+            meta = dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+        if not rows: return 0
+
+        records = DailyRecords()
+        decode_rows_into(records, self.codec, [row[:4] for row in rows])
+        target.save(records, [(r[0], r[1]) for r in rows], self._watermark_from_meta(meta))
+
+        # 書き出し中に更新された行は version が進んでいるため、次回また書き出される
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE daily_records SET exported_version = ? WHERE user_name = ? AND logical_date = ?",
+                [(version, user_name, date_str) for user_name, date_str, _, _, version in rows])
+        return len(rows)
+
+    def mark_unexported(self):
+        """全ての行を未反映に戻す (書き出し先のシートが作り直された場合に、次回の export_to で全件を書き出す)"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE daily_records SET exported_version = 0")
+
+    def _watermark_from_meta(self, meta):
+        watermark = new_watermark()
+        if meta.get('last_message_id'): watermark['last_message_id'] = int(meta['last_message_id'])
+        if meta.get('last_message_at'): watermark['last_message_at'] = meta['last_message_at']
+        if meta.get('user_ids'): watermark['user_ids'] = {k: int(v) for k, v in json.loads(meta['user_ids']).items()}
+        return watermark
+
+    def _meta_from_watermark(self, watermark):
+        return [
+            ('last_message_id', str(watermark['last_message_id'] or '')),
+            ('last_message_at', watermark['last_message_at'] or ''),
+            ('user_ids', json.dumps({k: str(v) for k, v in watermark['user_ids'].items()}, ensure_ascii=False)),
+        ]
@@ -0,0 +1,174 @@
+import collections
+import datetime
+import random
+from collections import defaultdict
+
+import pytest
+
+from aggregation import MonthlyAggregator, build_ranking
+from ingest import apply_message
+from publish import render_monthly_average_rows
+from records import DailyRecords
+from stats import analysis_period
+from timeutil import JST, extract_time_from_text, seconds_to_time_str, time_to_seconds
+
+# 差分集計 (MonthlyAggregator) の結果が、以前の全件走査による集計と一致することを確かめる
+
+Author = collections.namedtuple('Author', ['id', 'global_name', 'name', 'bot'])
+Message = collections.namedtuple('Message', ['id', 'author', 'created_at', 'content'])
+
+TEXTS = ['おはよう', '6時半', '7:10', '5時20分', '起きた', '23:00', 'おやすみ']
+
+# --- 以前の全件走査による集計 (perform_analysis / update_monthly_average_sheet のループの写し) ---
+def baseline_fold(messages):
+    user_daily_data = defaultdict(lambda: defaultdict(dict))
+    for message in messages:
+        if message.author.bot: continue
+        timestamp_jst = message.created_at.astimezone(JST)
+        user_name = message.author.global_name or message.author.name
+        logical_date_dt = timestamp_jst - datetime.timedelta(hours=4)
+        date_str = logical_date_dt.strftime("%Y-%m-%d")
+
+        hour = timestamp_jst.hour
+        is_wake = 4 <= hour < 18
+        record_key = 'wake' if is_wake else 'sleep'
+        dt_to_record = timestamp_jst
+
+        if is_wake:
+            ex_h, ex_m = extract_time_from_text(message.content)
+            if ex_h is not None and ex_m is not None:
+                if 4 <= ex_h < 18:
+                    dt_to_record = dt_to_record.replace(hour=ex_h, minute=ex_m, second=0, microsecond=0)
+
+        existing_dt = user_daily_data[user_name].get(date_str, {}).get(record_key)
+        if existing_dt is None or dt_to_record < existing_dt:
+            user_daily_data[user_name][date_str][record_key] = dt_to_record
+    return user_daily_data
+
+def baseline_ranking(user_daily_data, now_jst):
+    current_month, current_year = now_jst.month, now_jst.year
+    prev_month, prev_year = (12, current_year - 1) if current_month == 1 else (current_month - 1, current_year)
+
+    analysis_data = []
+    for user_name, daily_posts in user_daily_data.items():
+        all_wakes = []
+        cur_wakes, prev_wakes = [], []
+        cur_sleeps, prev_sleeps = [], []
+
+        for dt_dict in daily_posts.values():
+            if 'wake' in dt_dict:
+                w_dt = dt_dict['wake']
+                sec = time_to_seconds(w_dt)
+                all_wakes.append(sec)
+                if w_dt.year == current_year and w_dt.month == current_month: cur_wakes.append(sec)
+                if w_dt.year == prev_year and w_dt.month == prev_month: prev_wakes.append(sec)
+
+            if 'sleep' in dt_dict:
+                s_dt = dt_dict['sleep']
+                s_sec = time_to_seconds(s_dt, is_sleep=True)
+                s_logical = s_dt - datetime.timedelta(hours=4)
+                if s_logical.year == current_year and s_logical.month == current_month: cur_sleeps.append(s_sec)
+                if s_logical.year == prev_year and s_logical.month == prev_month: prev_sleeps.append(s_sec)
+
+        cur_w_avg = sum(cur_wakes) / len(cur_wakes) if cur_wakes else None
+        prev_w_avg = sum(prev_wakes) / len(prev_wakes) if prev_wakes else None
+
+        analysis_data.append({
+            'userName': user_name,
+            'overall_wake_avg': sum(all_wakes) / len(all_wakes) if all_wakes else None,
+            'overall_count': len(all_wakes),
+            'current_wake_avg': cur_w_avg,
+            'previous_wake_avg': prev_w_avg,
+            'current_sleep_avg': sum(cur_sleeps) / len(cur_sleeps) if cur_sleeps else None,
+            'previous_sleep_avg': sum(prev_sleeps) / len(prev_sleeps) if prev_sleeps else None,
+            'delta_sec': cur_w_avg - prev_w_avg if (cur_w_avg is not None and prev_w_avg is not None) else None
+        })
+
+    analysis_data.sort(key=lambda x: x['current_wake_avg'] if x['current_wake_avg'] is not None else float('inf'))
+    return analysis_data
+
+def baseline_monthly(user_daily_data):
+    all_year_months = sorted(list({k[:7].replace('-','/') for daily in user_daily_data.values() for k in daily.keys()}))
+
+    headers = ['ユーザー名']
+    for ym in all_year_months:
+        headers.append(f"{ym} 起床")
+        if ym >= "2026/05":
+            headers.append(f"{ym} 就寝")
+
+    rows = []
+    for user in sorted(user_daily_data.keys()):
+        row = [user]
+        for ym in all_year_months:
+            w_secs, s_secs = [], []
+            for d_str, times in user_daily_data[user].items():
+                if d_str.startswith(ym.replace('/','-')):
+                    if 'wake' in times: w_secs.append(time_to_seconds(times['wake']))
+                    if 'sleep' in times: s_secs.append(time_to_seconds(times['sleep'], is_sleep=True))
+
+            row.append(seconds_to_time_str(sum(w_secs)/len(w_secs)) if w_secs else "--:--")
+
+            if ym >= "2026/05":
+                row.append(seconds_to_time_str(sum(s_secs)/len(s_secs), is_sleep=True) if s_secs else "--:--")
+        rows.append(row)
+    return headers, rows
+
+# --- テスト ---
+def generate_messages(seed, users=6, days=120, shuffle=False):
+    rng = random.Random(seed)
+    authors = [Author(i, f"user{i}", f"user{i}", False) for i in range(users)]
+    authors.append(Author(99, 'bot', 'bot', True))
+    start = datetime.datetime(2026, 3, 1, 18, 0, tzinfo=datetime.timezone.utc)
+    messages = []
+    for day in range(days):
+        for author in authors:
+            if rng.random() < 0.25: continue
+            for _ in range(rng.randint(1, 3)):
+                created_at = start + datetime.timedelta(days=day, minutes=rng.randint(0, 24 * 60 - 1), seconds=rng.randint(0, 59))
+                messages.append(Message(len(messages) + 1, author, created_at, rng.choice(TEXTS)))
+    messages.sort(key=lambda m: m.created_at)
+    if shuffle: rng.shuffle(messages)
+    return messages
+
+def incremental(messages):
+    records, aggregator, user_ids = DailyRecords(), MonthlyAggregator(), {}
+    for message in messages:
+        apply_message(records, user_ids, message, aggregator)
+    return records, aggregator
+
+NOW = datetime.datetime(2026, 6, 15, 12, 0, tzinfo=JST)
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_ranking_matches_baseline(shuffle):
+    # shuffle すると、既に記録のある日により早い投稿が後から届き、記録が置き換えられる
+    messages = generate_messages(1, shuffle=shuffle)
+    records, aggregator = incremental(messages)
+    _, _, current_ym, prev_ym = analysis_period(NOW)
+
+    expected = baseline_ranking(baseline_fold(messages), NOW)
+    assert build_ranking(aggregator, current_ym, prev_ym) == expected
+    assert build_ranking(MonthlyAggregator.from_records(records), current_ym, prev_ym) == expected
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_monthly_rows_match_baseline(shuffle):
+    messages = generate_messages(2, shuffle=shuffle)
+    records, aggregator = incremental(messages)
+
+    expected = baseline_monthly(baseline_fold(messages))
+    assert render_monthly_average_rows(aggregator) == expected
+    assert render_monthly_average_rows(MonthlyAggregator.from_records(records)) == expected
+
+def test_earlier_post_replaces_existing_record():
+    author = Author(1, 'alice', 'alice', False)
+    later = Message(1, author, datetime.datetime(2026, 6, 10, 23, 0, tzinfo=datetime.timezone.utc), 'おはよう')  # 6/11 08:00 JST
+    earlier = Message(2, author, datetime.datetime(2026, 6, 10, 21, 30, tzinfo=datetime.timezone.utc), 'おはよう')  # 6/11 06:30 JST
+    other_day = Message(3, author, datetime.datetime(2026, 6, 11, 22, 0, tzinfo=datetime.timezone.utc), 'おはよう')  # 6/12 07:00 JST
+    messages = [later, other_day, earlier]
+    records, aggregator = incremental(messages)
+    _, _, current_ym, prev_ym = analysis_period(NOW)
+
+    ranking = build_ranking(aggregator, current_ym, prev_ym)
+    assert ranking == baseline_ranking(baseline_fold(messages), NOW)
+    assert ranking[0]['overall_count'] == 2
+    assert ranking[0]['current_wake_avg'] == (6.5 * 3600 + 7 * 3600) / 2
+    assert render_monthly_average_rows(aggregator) == baseline_monthly(baseline_fold(messages))
@@ -0,0 +1,96 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from codec import RowCodec, decode_seconds, decode_timestamp, encode_seconds
+from records import DailyRecords
+from storage import decode_rows_into
+from timeutil import JST, parse_timestamp_smart, time_to_seconds
+
+# 時刻セルの読み書きが、以前の dateutil による読み込み (parse_timestamp_smart) と同じ秒数になることを確かめる
+
+CELLS = [
+    ('2026-05-01T07:30:00+09:00', 'wake'),
+    ('2026-05-01T07:30:15.123456+09:00', 'wake'),
+    ('2026-05-01T07:30:15.5+09:00', 'wake'),
+    ('2026-05-01T07:30:00+0900', 'wake'),
+    ('2026-04-30T22:30:00Z', 'wake'),
+    ('2026-04-30T22:30:00+00:00', 'wake'),
+    ('2026-04-30T17:30:00-05:00', 'wake'),
+    ('2026-05-01T03:00:00+05:30', 'wake'),
+    ('2026-05-01T07:30:00', 'wake'),
+    ('2026-05-01 07:30:00', 'wake'),
+    ('2026-05-01T23:10:00+09:00', 'sleep'),
+    ('2026-05-02T01:15:00+09:00', 'sleep'),
+    ('2026-05-02T01:15:00.999999+09:00', 'sleep'),
+    ('2026-05-01T16:15:00Z', 'sleep'),
+    ('2025/05/01 7:30', 'wake'),
+    ('2025/05/01 23:45', 'sleep'),
+    ('07:30:00', 'wake'),
+    ('01:30:00', 'sleep'),
+]
+
+@pytest.mark.parametrize('value, kind', CELLS)
+def test_decode_seconds_matches_dateutil(value, kind):
+    expected = time_to_seconds(parse_timestamp_smart(value), is_sleep=kind == 'sleep')
+    assert decode_seconds(value, kind) == expected
+
+# コンパクト形式は日付を持たないため除く
+@pytest.mark.parametrize('value', [value for value, _ in CELLS if len(value) > 8])
+def test_decode_timestamp_matches_dateutil(value):
+    assert decode_timestamp(value) == parse_timestamp_smart(value)
+
+def test_compact_sleep_after_midnight():
+    # 24時以降の就寝はコンパクト形式では 25:30:00 のように書かれ、dateutil では読めない
+    assert decode_seconds('25:30:00', 'sleep') == 25 * 3600 + 30 * 60
+    assert decode_seconds('25:30', 'sleep') == 25 * 3600 + 30 * 60
+
+@pytest.mark.parametrize('value', [None, '', 'not a time'])
+def test_unreadable_cells(value):
+    assert decode_seconds(value, 'wake') is None
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('kind, sec', [('wake', 4 * 3600), ('wake', 7 * 3600 + 30 * 60 + 15), ('sleep', 22 * 3600 + 5), ('sleep', 25 * 3600 + 30 * 60), ('sleep', 27 * 3600 + 59 * 60 + 59)])
+def test_encode_decode_round_trip(compact, kind, sec):
+    assert decode_seconds(encode_seconds('2026-05-01', sec, compact), kind) == sec
+
+def test_encode_matches_previous_isoformat():
+    # 以前は JST の datetime をそのまま isoformat() で書いていた (24時以降の就寝は翌日の日付になる)
+    assert encode_seconds('2026-05-01', 7 * 3600 + 30 * 60) == datetime.datetime(2026, 5, 1, 7, 30, tzinfo=JST).isoformat()
+    assert encode_seconds('2026-05-01', 25 * 3600 + 15 * 60) == datetime.datetime(2026, 5, 2, 1, 15, tzinfo=JST).isoformat()
+    assert encode_seconds('2026-05-01', None) == ""
+
+@pytest.mark.parametrize('codec', [RowCodec(), RowCodec(compact=True), RowCodec(tz=ZoneInfo('America/New_York'))])
+def test_row_codec_round_trip(codec):
+    records = DailyRecords()
+    records.set_seconds('alice', '2026-03-08', 'wake', 6 * 3600 + 45 * 60)
+    records.set_seconds('alice', '2026-03-08', 'sleep', 24 * 3600 + 10 * 60)
+    records.set_seconds('bob', '2026-11-01', 'wake', 8 * 3600)
+
+    for user_name, date_str in records.rows():
+        row = codec.encode_row(records, user_name, date_str)
+        assert codec.decode_row(row) == (
+            user_name, date_str,
+            records.get_seconds(user_name, date_str, 'wake'),
+            records.get_seconds(user_name, date_str, 'sleep'),
+        )
+
+def test_row_codec_reads_legacy_rows():
+    # 旧3列形式 (就寝時刻列なし) と dateutil でしか読めない手入力のセル
+    codec = RowCodec()
+    assert codec.decode_row(['alice', '2025-05-01', '2025-05-01T07:30:00+09:00']) == ('alice', '2025-05-01', 27000, None)
+    assert codec.decode_row(['bob', '2025-05-01', '2025/05/01 7:30', '']) == ('bob', '2025-05-01', 27000, None)
+
+def test_decode_rows_skips_malformed_rows():
+    # SQLite・スプレッドシートのどちらの読み込みもこの関数を通るため、壊れた行の扱いは同じになる
+    rows = [
+        ['alice', '2026-05-01', '07:30:00', ''],
+        ['bob', 'not a date', '07:00:00', ''],
+        ['', '2026-05-01', '07:00:00', ''],
+        ['carol', '2026-05-02', '', '25:10:00'],
+    ]
+    records = DailyRecords()
+    assert decode_rows_into(records, RowCodec(compact=True), rows, first_row_number=2) == {('alice', '2026-05-01'): 2, ('carol', '2026-05-02'): 5}
+    assert list(records.rows()) == [('alice', '2026-05-01'), ('carol', '2026-05-02')]
+    assert records.get_seconds('carol', '2026-05-02', 'sleep') == 25 * 3600 + 10 * 60
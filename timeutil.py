@@ -0,0 +1,51 @@
+import datetime
+import re
+from dateutil import parser
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+# --- 時刻計算・フォーマット関数 ---
+def time_to_seconds(dt, is_sleep=False):
+    if dt is None: return None
+    h = dt.hour
+    # 就寝時間 (18:00~03:59) の平均計算のため、0~3時を24~27時として扱う
+    if is_sleep and h < 12:
+        h += 24
+    return h * 3600 + dt.minute * 60 + dt.second
+
+def seconds_to_time_str(seconds, is_sleep=False):
+    if seconds is None: return "--:--"
+    h = int(seconds // 3600)
+    m = int((seconds % 3600) // 60)
+    if is_sleep and h >= 24:
+        h -= 24
+    return f"{h:02d}:{m:02d}"
+
+def format_delta_seconds(seconds):
+    if seconds is None: return "N/A"
+    total_minutes = round(seconds / 60)
+    sign = "+" if total_minutes >= 0 else "-"
+    return f"{sign}{abs(total_minutes)}分"
+
+def parse_timestamp_smart(timestamp_str, tz=JST):
+    if not timestamp_str: return None
+    try:
+        dt = parser.parse(str(timestamp_str))
+        if dt.tzinfo is None:
+             dt = dt.replace(tzinfo=tz)
+        else:
+             dt = dt.astimezone(tz)
+        return dt
+    except Exception:
+        return None
+
+# "H:MM" を優先し、無ければ "H時" / "H時M分" / "H時半" を探す
+# (1つ目の選択肢が本文のどこにも無い場合にだけ2つ目を試すため、別々に検索した場合と同じ優先順位になる)
+TIME_PATTERN = re.compile(r'.*?(\d{1,2})[:：](\d{2})|.*?(\d{1,2})時(?:(半)|(\d{1,2})分)?', re.DOTALL)
+
+def extract_time_from_text(text):
+    match = TIME_PATTERN.match(text)
+    if not match: return None, None
+    if match.group(1) is not None: return int(match.group(1)), int(match.group(2))
+    if match.group(4): return int(match.group(3)), 30
+    return int(match.group(3)), int(match.group(5) or 0)